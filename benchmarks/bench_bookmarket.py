@@ -0,0 +1,195 @@
+"""
+Reproducible benchmarks of the Bookmarket operations on synthetic databases
+and of the scraping path against a local stand-in HTTP server.
+
+    python benchmarks/bench_bookmarket.py --sizes 1000 10000 100000 --backend tinydb sqlite log
+    python benchmarks/bench_bookmarket.py --sizes 1000 --json out.json  # save the results to compare runs
+
+For each operation it reports throughput, latency percentiles and the
+peak memory allocated by one call (tracemalloc, only the first call is
+traced and it is not timed as tracing slows down the code it watches).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import replace
+import statistics
+import tracemalloc
+import threading
+import argparse
+import tempfile
+import random
+import shutil
+import json
+import time
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bookmarket.bookmarket import Bookmarket, Record, Q, find_infos  # noqa: E402
+
+WORDS = ('python attention transformer paper video music recipe travel news rust linux '
+         'database search index cache tutorial guide review benchmark release blog').split()
+EXTENSIONS = {'tinydb': '.json', 'sqlite': '.sqlite', 'log': '.jsonl'}
+
+
+def synthetic_records(n, seed=0):
+    rng = random.Random(seed)
+    t0 = 1.6e9
+    for i in range(n):
+        words = rng.sample(WORDS, 4)
+        yield Record(url=f'https://www.{words[0]}{i}.com/{words[1]}/{i}',
+                     title=' '.join(words[:3]).title(),
+                     info=' '.join(rng.choices(WORDS, k=12)),
+                     ts=t0 + i * 60 + rng.random())
+
+
+def measure(name, fn, args_list, reset=None):
+    """
+    Run fn(*args) for each args, returns the per call latencies stats and peak memory.
+    The first call is traced and not timed, a single call is then run again untraced
+    for its latency, after reset() when it can't simply be repeated (a bulk write)
+    """
+    tracemalloc.start()
+    fn(*args_list[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if len(args_list) == 1 and reset is not None:
+        reset()
+    latencies = []
+    for args in args_list[1:] or args_list:
+        t0 = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - t0)
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1e3
+
+    total = sum(latencies)
+    return {'op': name, 'calls': len(latencies), 'ops_s': len(latencies) / total if total else float('inf'),
+            'mean_ms': statistics.mean(latencies) * 1e3, 'p50_ms': pct(50), 'p95_ms': pct(95),
+            'p99_ms': pct(99), 'peak_mib': peak / 2 ** 20}
+
+
+def bench_db(backend, n, ops, tmp):
+    path = os.path.join(tmp, f'bench_{n}{EXTENSIONS[backend]}')
+    rs = list(synthetic_records(n))
+    rng = random.Random(1)
+    sample = rng.sample(rs, min(ops, n))
+    results = []
+
+    bm = Bookmarket(path, backend=backend)
+    results.append(measure('write bulk', bm.write, [(rs,)], reset=bm.truncate))
+    bm.close()
+    results.append(measure('open', lambda: Bookmarket(path, backend=backend).close(), [()]))
+
+    bm = Bookmarket(path, backend=backend)
+    extra = [(Record(url=f'https://www.extra.com/{i}', title='extra', ts=2e9 + i),) for i in range(ops)]
+    results.append(measure('write single', bm.write, extra))
+    results.append(measure('get_url', bm.get_url, [(r.url,) for r in sample]))
+    results.append(measure('get query', bm.get, [(Q.url == r.url,) for r in sample[:max(1, ops // 10)]]))
+    queries = [tuple(rng.sample(WORDS, k)) for k in (1, 2, 3) for _ in range(max(1, ops // 3))]
+    results.append(measure('search_text', lambda *k: list(bm.iter_text(*k)), queries))
+    results.append(measure('search_text top 20', lambda *k: list(bm.iter_text(*k, limit=20, order='-ts')),
+                           queries))
+    results.append(measure('search_ranked top 10', lambda *k: (bm.queries.clear(), bm.search_ranked(*k, k=10)),
+                           queries[:1] + queries))  # The first (untimed) call builds the index
+    t0, t1 = rs[0].ts, rs[-1].ts
+    ranges = [sorted((rng.uniform(t0, t1), rng.uniform(t0, t1))) for _ in range(ops)]
+    results.append(measure('stime', bm.stime, ranges))
+    results.append(measure('count_time', bm.count_time, ranges))
+    results.append(measure('smatch', bm.smatch, [(Record(title=r.title),) for r in sample[:max(1, ops // 10)]]))
+    results.append(measure('update', bm.update, [(replace(r, info='updated'),) for r in sample]))
+    results.append(measure('all', bm.all, [()] * 3))
+    results.append(measure('delete', bm.delete, [(r,) for r in sample]))
+    bm.close()
+    return results
+
+
+class SlowSite(BaseHTTPRequestHandler):
+    """Local stand-in for the scraped sites, answers after `delay` seconds"""
+    delay = 0.05
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = (f'<html><head><title>page {self.path}</title>'
+                f'<meta property="og:description" content="about {self.path}"></head>'
+                '<body>' + 'x' * 100000 + '</body></html>').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):  # the client stops after </head>
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_fetch(backend, n, latency, workers, tmp):
+    SlowSite.delay = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowSite)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    results = []
+    try:
+        results.append(measure('find_infos', find_infos, [(f'{base}/{i}',) for i in range(min(n, 50))]))
+        bm = Bookmarket(os.path.join(tmp, f'bench_fetch{EXTENSIONS[backend]}'), backend=backend)
+        bm.truncate()
+        bm.write([Record(url=f'{base}/{i}', ts=float(i)) for i in range(n)])
+        for w in sorted({1, workers}):
+            res = measure(f'update_all workers={w}',
+                          lambda: bm.update_all(workers=w, per_host=w, progress=lambda *a: None), [()])
+            res['ops_s'] = n / (res['mean_ms'] / 1e3)  # pages per second
+            results.append(res)
+        bm.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def print_table(title, results):
+    print(f'\n{title}')
+    print(f'{"op":24} {"calls":>6} {"ops/s":>12} {"mean ms":>9} {"p50 ms":>9} '
+          f'{"p95 ms":>9} {"p99 ms":>9} {"peak MiB":>9}')
+    for r in results:
+        print(f'{r["op"]:24} {r["calls"]:6d} {r["ops_s"]:12.1f} {r["mean_ms"]:9.3f} {r["p50_ms"]:9.3f} '
+              f'{r["p95_ms"]:9.3f} {r["p99_ms"]:9.3f} {r["peak_mib"]:9.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--backend', nargs='+', default=['tinydb'], choices=list(EXTENSIONS))
+    parser.add_argument('--ops', type=int, default=200, help='calls timed for each operation')
+    parser.add_argument('--latency', type=float, default=0.05, help='stand-in server latency (s)')
+    parser.add_argument('--pages', type=int, default=40, help='records refreshed by update_all')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--no-fetch', action='store_true', help='skip the scraping benchmarks')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    report = {'args': vars(args), 'python': sys.version, 'results': {}}
+    tmp = tempfile.mkdtemp(prefix='bookmarket_bench_')
+    try:
+        for backend in args.backend:
+            for n in args.sizes:
+                title = f'{backend} {n} records'
+                report['results'][title] = bench_db(backend, n, args.ops, tmp)
+                print_table(title, report['results'][title])
+            if not args.no_fetch:
+                title = f'{backend} scraping, {args.pages} pages, {args.latency * 1e3:.0f} ms latency'
+                report['results'][title] = bench_fetch(backend, args.pages, args.latency, args.workers, tmp)
+                print_table(title, report['results'][title])
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Compare the slotted Record with the previous dict backed dataclass:
+memory of 100k records and time to convert storage documents to records and back.
+
+    python benchmarks/bench_record.py [n]
+"""
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+import tracemalloc
+import timeit
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bookmarket.bookmarket import Record  # noqa: E402
+
+
+@dataclass(frozen=True, order=True)
+class DictRecord:  # Record before it was slotted
+    url: Optional[str] = field(default=None, compare=False)
+    title: Optional[str] = field(default=None, compare=False)
+    info: Optional[str] = field(default=None, compare=False)
+    ts: Optional[float] = field(default=None, compare=True)
+
+
+def docs(n):
+    return [{'url': f'https://www.site{i}.com', 'title': f'title {i}', 'info': f'info {i}', 'ts': float(i)}
+            for i in range(n)]
+
+
+def memory(build, ds):
+    tracemalloc.start()
+    objs = build(ds)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size
+
+
+def main(n=100000):
+    ds = docs(n)
+    cases = {
+        'dataclass Record(**doc)': (lambda ds: [DictRecord(**d) for d in ds], lambda rs: [asdict(r) for r in rs]),
+        'slotted Record.from_doc': (lambda ds: [Record.from_doc(d) for d in ds], lambda rs: [r.to_doc() for r in rs]),
+    }
+    print(f'{n} records')
+    for name, (build, to_docs) in cases.items():
+        rs = build(ds)
+        mem = memory(build, ds)
+        t_build = min(timeit.repeat(lambda: build(ds), number=1, repeat=5))
+        t_docs = min(timeit.repeat(lambda: to_docs(rs), number=1, repeat=5))
+        print(f'{name:25} memory {mem / 2 ** 20:7.2f} MiB  '
+              f'doc -> record {t_build * 1e3:8.1f} ms  record -> doc {t_docs * 1e3:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,261 @@
+"""
+Optional archive of the text of the bookmarked pages, so their content can be
+searched and is not lost when a link dies.
+Texts are compressed (zstd if the zstandard package is installed, else gzip)
+and stored once per content in blobs/<2 hex>/<sha256>: pages with the same
+text share the blob. Blobs are read through mmap.
+An SQLite database maps urls to blobs and holds a contentless FTS5 index of
+the texts. Past `max_bytes` of blobs the least recently used ones are evicted.
+"""
+from contextlib import contextmanager
+from hashlib import sha256
+from typing import Iterable, List, Optional, Tuple
+import threading
+import sqlite3
+import mmap
+import zlib
+import time
+import os
+try:
+    import zstandard
+except ImportError:  # gzip only
+    zstandard = None
+try:
+    from .storage import TOKEN_RE
+except ImportError:  # running the bot as a script from the bookmarket folder
+    from storage import TOKEN_RE
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSIONS = ('zstd', 'gzip')
+
+
+class PageArchive:
+    """
+    Archive in the `root` folder. Texts longer than max_page_chars are cut,
+    when the blobs exceed max_bytes the least recently used (archived or read)
+    are evicted down to evict_ratio * max_bytes, with their pages and index entries.
+    Thread-safe, the database is used under a lock and compression happens outside it.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS blobs (
+        id INTEGER PRIMARY KEY, hash TEXT NOT NULL UNIQUE, size INTEGER NOT NULL, used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used);
+    CREATE TABLE IF NOT EXISTS pages (
+        url TEXT PRIMARY KEY, blob INTEGER NOT NULL, archived REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS pages_blob ON pages (blob);
+    CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(body, content='');
+    """
+
+    def __init__(self, root: str, max_bytes: int = 256 * 1024 * 1024, max_page_chars: int = 512 * 1024,
+                 compression: Optional[str] = None, evict_ratio: float = 0.9):
+        if compression is None:
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression!r}, use one of {COMPRESSIONS}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_page_chars = max_page_chars
+        self.compression = compression
+        self.evict_ratio = evict_ratio
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        self.con = sqlite3.connect(os.path.join(root, 'archive.sqlite'), check_same_thread=False,
+                                   isolation_level=None)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._written: List[str] = []  # blob files of the open transaction, removed on rollback
+        self._dropped: List[str] = []  # and the ones to remove on commit
+        self.bytes = self.con.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self.con.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def __contains__(self, url: str) -> bool:
+        with self._lock:
+            return self.con.execute('SELECT 1 FROM pages WHERE url = ?', (url,)).fetchone() is not None
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Hold the lock in a transaction, blob files follow its outcome
+        """
+        with self._lock:
+            self.con.execute('BEGIN IMMEDIATE')
+            size = self.bytes
+            self._written, self._dropped = [], []
+            try:
+                yield
+                self.con.execute('COMMIT')
+            except BaseException:
+                self.con.execute('ROLLBACK')
+                self.bytes = size
+                self._dropped = self._written
+                raise
+            finally:
+                for path in self._dropped:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=10).compress(data)
+        return zlib.compress(data, 9, wbits=31)  # gzip container
+
+    @staticmethod
+    def _decompress(buf) -> bytes:
+        # Any blob can be read whatever the current compression, the magic tells them apart
+        if buf[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise ValueError('The blob is zstd compressed, install zstandard to read it')
+            return zstandard.ZstdDecompressor().decompressobj().decompress(buf)
+        if buf[:2] == GZIP_MAGIC:
+            return zlib.decompress(buf, wbits=31)
+        raise ValueError('Unknown blob format')
+
+    def _read(self, digest: str) -> Optional[str]:
+        try:
+            with open(self._path(digest), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return self._decompress(m).decode('utf-8')
+        except FileNotFoundError:  # Evicted meanwhile
+            return None
+
+    def put(self, url: str, text: str) -> str:
+        """
+        Archive the text of url (replacing the previous one), returns its hash
+        """
+        data = text[:self.max_page_chars].encode('utf-8')
+        digest = sha256(data).hexdigest()
+        with self._lock:
+            known = self.con.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        blob = None if known else self._compress(data)
+
+        now = time.time()
+        with self._transaction():
+            row = self.con.execute('SELECT id FROM blobs WHERE hash = ?', (digest,)).fetchone()
+            if row is None:
+                if blob is None:  # Evicted since the first look
+                    blob = self._compress(data)
+                path = self._path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(blob)
+                os.replace(path + '.tmp', path)
+                self._written.append(path)
+                blob_id = self.con.execute('INSERT INTO blobs (hash, size, used) VALUES (?, ?, ?)',
+                                           (digest, len(blob), now)).lastrowid
+                self.con.execute('INSERT INTO pages_fts (rowid, body) VALUES (?, ?)',
+                                 (blob_id, data.decode('utf-8')))
+                self.bytes += len(blob)
+            else:
+                blob_id = row[0]
+                self.con.execute('UPDATE blobs SET used = ? WHERE id = ?', (now, blob_id))
+            old = self.con.execute('SELECT blob FROM pages WHERE url = ?', (url,)).fetchone()
+            self.con.execute('INSERT OR REPLACE INTO pages (url, blob, archived) VALUES (?, ?, ?)',
+                             (url, blob_id, now))
+            if old is not None and old[0] != blob_id:
+                self._release(old[0])
+        if self.bytes > self.max_bytes:
+            self.evict()
+        return digest
+
+    def _release(self, blob_id: int) -> None:
+        """
+        Drop a blob no page uses anymore, inside a _transaction
+        """
+        if self.con.execute('SELECT 1 FROM pages WHERE blob = ? LIMIT 1', (blob_id,)).fetchone():
+            return None
+        digest, size = self.con.execute('SELECT hash, size FROM blobs WHERE id = ?', (blob_id,)).fetchone()
+        text = self._read(digest)
+        if text is not None:  # A contentless index needs the text to remove it
+            self.con.execute("INSERT INTO pages_fts (pages_fts, rowid, body) VALUES ('delete', ?, ?)",
+                             (blob_id, text))
+        self.con.execute('DELETE FROM blobs WHERE id = ?', (blob_id,))
+        self._dropped.append(self._path(digest))
+        self.bytes -= size
+        return None
+
+    def get(self, url: str) -> Optional[str]:
+        """
+        Archived text of url, None if it is not archived
+        """
+        with self._lock:
+            row = self.con.execute('SELECT blobs.id, hash FROM pages JOIN blobs ON blobs.id = pages.blob '
+                                   'WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            self.con.execute('UPDATE blobs SET used = ? WHERE id = ?', (time.time(), row[0]))
+        return self._read(row[1])
+
+    def remove(self, url: str) -> bool:
+        """
+        Forget the text of url, False if it was not archived
+        """
+        with self._transaction():
+            row = self.con.execute('SELECT blob FROM pages WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                self.con.execute('DELETE FROM pages WHERE url = ?', (url,))
+                self._release(row[0])
+        return row is not None
+
+    def search(self, keywords: Iterable[str], k: int = 10) -> List[Tuple[str, float]]:
+        """
+        The k (url, score) pairs whose text has every keyword (as a token prefix), best BM25 first.
+        Matched blobs count as used for the eviction
+        """
+        tokens = {t for kw in keywords for t in TOKEN_RE.findall(kw.lower())}
+        if not tokens:
+            return []
+        query = ' AND '.join(f'"{t}"*' for t in sorted(tokens))
+        with self._lock:
+            rows = self.con.execute(
+                'SELECT pages.url, pages.blob, m.score FROM '
+                '(SELECT rowid, bm25(pages_fts) AS score FROM pages_fts WHERE pages_fts MATCH ? '
+                ' ORDER BY score LIMIT ?) AS m JOIN pages ON pages.blob = m.rowid ORDER BY m.score',
+                (query, k)).fetchall()
+            self.con.executemany('UPDATE blobs SET used = ? WHERE id = ?',
+                                 [(time.time(), blob_id) for blob_id in {row[1] for row in rows}])
+        return [(url, -score) for url, _, score in rows[:k]]  # bm25() is lower for better matches
+
+    def evict(self, target: Optional[int] = None) -> int:
+        """
+        Evict the least recently used blobs (and their pages) until the blobs take at most
+        target bytes (evict_ratio * max_bytes by default). Returns how many were evicted
+        """
+        if target is None:
+            target = int(self.max_bytes * self.evict_ratio)
+        evicted = 0
+        with self._transaction():
+            while self.bytes > target:
+                ids = [row[0] for row in self.con.execute('SELECT id FROM blobs ORDER BY used LIMIT 64')]
+                if not ids:
+                    break
+                for blob_id in ids:
+                    if self.bytes <= target:
+                        break
+                    self.con.execute('DELETE FROM pages WHERE blob = ?', (blob_id,))
+                    self._release(blob_id)
+                    evicted += 1
+        return evicted
+
+    def size_on_disk(self) -> int:
+        """
+        Bytes of the blobs plus the database with the full-text index
+        """
+        db = os.path.join(self.root, 'archive.sqlite')
+        return self.bytes + sum(os.path.getsize(db + s) for s in ('', '-wal') if os.path.isfile(db + s))
+
+    def close(self) -> None:
+        with self._lock:
+            self.con.close()
@@ -1,29 +1,81 @@
-from tinydb import TinyDB, Query, where
-from dataclasses import dataclass, field, asdict, replace
+from tinydb import Query, where
+from dataclasses import dataclass, field, replace
 from datetime import datetime
 from enforce_typing import enforce_types  # type: ignore
-from typing import Optional, Sequence, Union, List
+from typing import Optional, Sequence, Union, List, Iterable, Iterator, Callable, Dict
 from datetime import datetime
-from bs4 import BeautifulSoup
-from tinyrecord import transaction
+from html.parser import HTMLParser
+from collections import defaultdict, OrderedDict, Counter
+from contextlib import contextmanager
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import zip_longest, islice
+from urllib.parse import urlparse
+import threading
+import logging
+import codecs
+import json
+import os
 import requests
 import socket
 import time
+import sys
+try:
+    from .storage import open_storage, tokenize, ORDERS, FIELDS
+    from .metrics import METRICS
+    from .ranking import BM25Index
+    from . import formats
+    from .locks import RWLock
+    from .canonical import Canonicalizer
+    from .archive import PageArchive
+except ImportError:  # running the bot as a script from the bookmarket folder
+    from storage import open_storage, tokenize, ORDERS, FIELDS
+    from metrics import METRICS
+    from ranking import BM25Index
+    import formats
+    from locks import RWLock
+    from canonical import Canonicalizer
+    from archive import PageArchive
 Q = Query()
+logger = logging.getLogger(__name__)
+MAX_HEAD_BYTES = 512 * 1024  # stop reading a page after this many bytes
+MAX_PAGE_BYTES = 4 * 1024 * 1024  # same when the whole page is read for its text
 session = requests.Session()
 session.max_redirects = 3
 
 
+# Slotted records (python >= 3.10) have no per instance __dict__
+SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+
 # @enforce_types  # TODO: Wrap manually before writing if you want
-@dataclass(frozen=True, order=True)
+@dataclass(frozen=True, order=True, **SLOTS)
 class Record:
     url: Optional[str] = field(default=None, compare=False)
     title: Optional[str] = field(default=None, compare=False)
     info: Optional[str] = field(default=None, compare=False)
     ts: Optional[float] = field(default=None, compare=True)
+    # Fetch metadata: when the site was last scraped, the http status it answered
+    # (0 if it could not be reached) and the consecutive failed fetches
+    fetched: Optional[float] = field(default=None, compare=False)
+    status: Optional[int] = field(default=None, compare=False)
+    failures: Optional[int] = field(default=None, compare=False)
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> 'Record':
+        """
+        Build a record from a storage document without going through __init__
+        """
+        r = object.__new__(cls)
+        for name, setter in _SETTERS:
+            setter(r, doc.get(name))
+        return r
+
+    def to_doc(self) -> dict:
+        return {name: getattr(self, name) for name in FIELDS}
 
     def query_dict(self):
-        return {x: k for x, k in asdict(self).items() if k is not None}
+        return {name: getattr(self, name) for name in FIELDS if getattr(self, name) is not None}
 
     @property
     def human_ts(self):
@@ -33,29 +85,388 @@ class Record:
             return None
 
 
+# Writing the slots directly is the fastest way to fill a frozen record
+_SETTERS = tuple((name, getattr(Record, name).__set__ if SLOTS else
+                  lambda r, v, name=name: object.__setattr__(r, name, v)) for name in FIELDS)
+
+
 # typing utility objects
 Records = Union[Record, Sequence[Record]]
 OptTimeType = Optional[Union[float, datetime]]
 
 
-def find_infos(url):
+class FetchCache:
+    """
+    On-disk cache of the metadata scraped by find_infos, keyed by sanitized url.
+    Entries are fresh for `ttl` seconds, stale entries are revalidated with a
+    conditional request (If-None-Match / If-Modified-Since) so unchanged pages
+    are not downloaded again. Past `max_entries` the least recently used are evicted.
+    With path=None the cache only lives in memory.
+    """
+    def __init__(self, path: Optional[str] = None, ttl: float = 60 * 60 * 24 * 7,
+                 max_entries: int = 10000, save_every: int = 50):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_every = save_every
+        # hits: fresh entries, revalidated: stale entries confirmed by a 304, misses: downloads
+        self.counts = Counter(hits=0, revalidated=0, misses=0)
+        self._entries = OrderedDict()
+        self._dirty = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self._entries.update(json.load(f))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(sanitize_url(url))
+            if entry is not None:
+                self._entries.move_to_end(sanitize_url(url))
+            return entry
+
+    def fresh(self, entry: dict) -> bool:
+        return time.time() - entry['fetched'] < self.ttl
+
+    def put(self, url: str, title, info, etag=None, last_modified=None, final_url=None) -> None:
+        entry = {'url': final_url or url, 'title': title, 'info': info, 'etag': etag,
+                 'last_modified': last_modified, 'fetched': time.time()}
+        with self._lock:
+            self._entries[sanitize_url(url)] = entry
+            self._entries.move_to_end(sanitize_url(url))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty += 1
+            save = self._dirty >= self.save_every
+        if save:
+            self.save()
+
+    def touch(self, url: str) -> None:
+        """
+        Mark an entry as fresh again after a successful revalidation
+        """
+        with self._lock:
+            self._entries[sanitize_url(url)]['fetched'] = time.time()
+            self._dirty += 1
+
+    def count(self, outcome: str) -> None:
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self) -> dict:
+        total = sum(self.counts.values())
+        hit_rate = (self.counts['hits'] + self.counts['revalidated']) / total if total else 0.0
+        return {'entries': len(self), **self.counts, 'hit_rate': hit_rate}
+
+    def save(self) -> None:
+        if self.path is None:
+            return None
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+            self._dirty = 0
+        return None
+
+
+@dataclass(frozen=True)
+class FetchResult:
+    """
+    Outcome of a single fetch: whether the site could be opened,
+    the url it redirected to and the metadata found in its <head>
+    """
+    url: str
+    ok: bool = False
+    title: Optional[str] = None
+    info: Optional[str] = None
+    status: Optional[int] = None
+    text: Optional[str] = field(default=None, repr=False)  # visible text of the page, if asked for
+
+
+def fetch(url, cache: Optional[FetchCache] = None, revalidate: bool = False, text: bool = False) -> FetchResult:
+    """
+    Open url with a single request and scrape title and og:description.
+    If a cache is passed fresh entries are returned without any request
+    and stale ones (or all of them with revalidate) are checked with a conditional request.
+    With text the whole page is read and its visible text returned too
+    (not for answers coming from the cache or a 304).
+    """
+    if not METRICS.enabled:
+        return _fetch(url, cache, revalidate, text)
+    with METRICS.timer('bookmarket_fetch_seconds'):
+        res = _fetch(url, cache, revalidate, text)
+    METRICS.inc('bookmarket_fetch_total', status=(res.status or 'cached') if res.ok else 'error')
+    return res
+
+
+def _fetch(url, cache, revalidate, text=False) -> FetchResult:
+    entry = cache.get(url) if cache is not None else None
+    if entry is not None and not revalidate and cache.fresh(entry):
+        cache.count('hits')
+        return FetchResult(entry.get('url', url), True, entry['title'], entry['info'])
+
+    headers = {'User-Agent': 'Magic Browser'}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
     try:
-        req = session.get(url, timeout=3, headers={'User-Agent': 'Magic Browser'})
-    except (requests.Timeout, requests.HTTPError, requests.ConnectionError):
-        return None, None
+        req = session.get(url, timeout=3, headers=headers, stream=True)
+    except requests.RequestException as e:
+        METRICS.inc('bookmarket_fetch_errors_total', error=type(e).__name__)
+        return FetchResult(url)
+
+    with req:
+        if entry is not None and req.status_code == 304:
+            cache.count('revalidated')
+            cache.touch(url)
+            return FetchResult(entry.get('url', url), True, entry['title'], entry['info'], 304)
+        if cache is not None:
+            cache.count('misses')
+
+        page = None
+        try:
+            if text:
+                title, info, page = read_page(req)
+            else:
+                title, info = read_head(req)
+        except requests.RequestException as e:
+            METRICS.inc('bookmarket_fetch_errors_total', error=type(e).__name__)
+            title, info = None, None
 
-    soup = BeautifulSoup(req.content.decode('utf-8', 'ignore'), features='lxml')
-    try:  # Try to get a title
-        title = str(soup.title.string)
-    except AttributeError:
+    if title is not None and cache is not None:
+        cache.put(url, title, info, req.headers.get('ETag'), req.headers.get('Last-Modified'),
+                  final_url=req.url)
+    return FetchResult(req.url, True, title, info if title is not None else None, req.status_code, page)
+
+
+def find_infos(url, cache: Optional[FetchCache] = None, revalidate: bool = False):
+    """
+    Scrape title and og:description of url, see fetch.
+    Returns (None, None) if the site has no title or could not be opened.
+    """
+    res = fetch(url, cache, revalidate)
+    return res.title, res.info
+
+
+class _HeadParser(HTMLParser):
+    """
+    Incremental parser that only collects <title> and og:description,
+    done is set as soon as the <head> is over.
+    """
+    def __init__(self):
+        super().__init__()
+        self.title = None
+        self.info = None
+        self.done = False
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and self.title is None:
+            self.title = ''
+            self._in_title = True
+        elif tag == 'meta' and self.info is None:
+            attrs = dict(attrs)
+            if attrs.get('property') == 'og:description':
+                self.info = attrs.get('content')
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+
+
+class _PageParser(_HeadParser):
+    """
+    _HeadParser that goes on past the <head> and keeps the text of the page
+    outside scripts, styles and the title
+    """
+    SKIP = ('script', 'style', 'noscript', 'template', 'svg')
+
+    def __init__(self):
+        super().__init__()
+        self.text = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        super().handle_starttag(tag, attrs)
+        self.done = False
+        if tag in self.SKIP:
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        super().handle_endtag(tag)
+        self.done = False
+        if tag in self.SKIP and self._skipping:
+            self._skipping -= 1
+
+    def handle_data(self, data):
+        super().handle_data(data)
+        if not self._skipping and not self._in_title:
+            data = ' '.join(data.split())
+            if data:
+                self.text.append(data)
+
+
+def _parse(req: requests.Response, parser: _HeadParser, max_bytes: int) -> bool:
+    """
+    Feed the body of a response to parser until it is done (or max_bytes),
+    returns False without reading anything if the response is not html
+    """
+    ctype = req.headers.get('Content-Type', 'text/html')
+    if 'html' not in ctype:
+        return False
+
+    encoding = req.encoding if 'charset' in ctype else 'utf-8'
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)('ignore')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+
+    read = 0
+    for chunk in req.iter_content(chunk_size=8192):
+        parser.feed(decoder.decode(chunk))
+        read += len(chunk)
+        if parser.done or read >= max_bytes:
+            break
+    parser.close()
+    return True
+
+
+def read_head(req: requests.Response, max_bytes: int = MAX_HEAD_BYTES):
+    """
+    Stream the body of a response until the end of <head> (or max_bytes)
+    and return its title and og:description. Non html responses are not read.
+    """
+    parser = _HeadParser()
+    if not _parse(req, parser, max_bytes):
         return None, None
+    title = parser.title.strip() if parser.title else None
+    return title or None, parser.info
+
+
+def read_page(req: requests.Response, max_bytes: int = MAX_PAGE_BYTES):
+    """
+    Like read_head but the whole page (up to max_bytes) is read,
+    returns title, og:description and the visible text (None if empty)
+    """
+    parser = _PageParser()
+    if not _parse(req, parser, max_bytes):
+        return None, None, None
+    title = parser.title.strip() if parser.title else None
+    return title or None, parser.info, '\n'.join(parser.text) or None
+
+
+class QueryCache:
+    """
+    LRU cache of query results, past `max_entries` the least recently used are evicted.
+    Each result is stored with the database generation it was computed at and
+    is only returned while the generation is the same, so writes invalidate
+    every entry at once without touching them. max_entries=0 disables it.
+    """
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.counts = Counter(hits=0, misses=0)
+        self._entries = OrderedDict()  # key -> (generation, result, extra)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation: int, valid=None):
+        """
+        Cached result of key, None if missing or stale.
+        valid(extra) can reject an entry with the extra value it was stored with
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] != generation or (valid is not None and not valid(entry[2])):
+            with self._lock:
+                self.counts['misses'] += 1
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.counts['hits'] += 1
+        return entry[1]
+
+    def put(self, key, generation: int, result, extra=None) -> None:
+        if not self.max_entries:
+            return None
+        with self._lock:
+            self._entries[key] = (generation, result, extra)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        total = sum(self.counts.values())
+        hit_rate = self.counts['hits'] / total if total else 0.0
+        return {'entries': len(self), **self.counts, 'hit_rate': hit_rate}
+
+
+class HostBackoff:
+    """
+    Exponential backoff of the hosts that keep failing: after n consecutive
+    failures a host is skipped for base * 2 ** (n - 1) seconds, at most max_delay.
+    With a path the state is saved there and survives restarts.
+    """
+    def __init__(self, path: Optional[str] = None, base: float = 60 * 15,
+                 max_delay: float = 60 * 60 * 24 * 7):
+        self.path = path
+        self.base = base
+        self.max_delay = max_delay
+        self._hosts = {}  # host -> [consecutive failures, retry at]
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self._hosts.update(json.load(f))
+
+    def delay(self, failures: int) -> float:
+        return min(self.max_delay, self.base * 2 ** (failures - 1)) if failures else 0
 
-    try:  # Try to get a description
-        info = soup.find('meta', property='og:description')['content']
-    except TypeError:
-        info = None
+    def ready(self, host: str) -> bool:
+        with self._lock:
+            state = self._hosts.get(host)
+        return state is None or time.time() >= state[1]
+
+    def failed(self, host: str) -> None:
+        with self._lock:
+            failures = self._hosts.get(host, [0, 0])[0] + 1
+            self._hosts[host] = [failures, time.time() + self.delay(failures)]
+
+    def succeeded(self, host: str) -> None:
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def save(self) -> None:
+        if self.path is None:
+            return None
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._hosts, f)
+            os.replace(tmp, self.path)
+        return None
 
-    return title, info
 
 def sanitize_url(url):
     if url.endswith('.pdf'):
@@ -65,95 +476,539 @@ def sanitize_url(url):
     return url
 
 
+def _reading(method):
+    """
+    Run a Bookmarket method holding the read lock
+    """
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return locked
+
+
 class Bookmarket:
     """
     Main class, holds a reference to the database containing the bookmarks.
     Manages the methods that allow to write / read / view the database.
     Telegram etc will communicate with an instance of Bookmarket.
+    The database is a TinyDB json file or, for .sqlite / .db paths, a SQLite
+    database (see storage.py), backend can be used to choose explicitly.
+    The results of search, search_text, smatch and stime are kept in a
+    QueryCache of query_cache_size entries.
+    Reads hold the read side of a RWLock and run in parallel, batches hold the
+    write side: a read sees a batch either fully committed or not at all.
+    Lazy iter_* methods take the read lock for each chunk of records they pull.
+    Urls with the same canonical key (see canonical.py, `canonical` maps a url
+    to its key) are duplicates: write refuses them and dedupe merges them.
+    With a PageArchive the text of the pages refetched by update_all / refresh_stale
+    is archived and searched by search_pages.
     """
-    def __init__(self, db_path):
-        self.db = TinyDB(db_path)
+    def __init__(self, db_path, cache: Optional[FetchCache] = None, backend: Optional[str] = None,
+                 query_cache_size: int = 256, canonical: Optional[Callable[[str], str]] = None,
+                 archive: Optional[PageArchive] = None):
+        self.path = db_path
+        self.storage = open_storage(db_path, backend)
+        self.cache = cache  # used when scraping sites
+        self.archive = archive
+        self._unarchive: List[str] = []  # urls deleted by the open batch, dropped from the archive on commit
+        self.queries = QueryCache(query_cache_size)
+        self.canonical = Canonicalizer() if canonical is None else canonical
+        self.generation = 0  # bumped by every batch and truncate, invalidates self.queries
+        self._ranking = None  # BM25Index, built by the first search_ranked
+        self._ranking_lock = threading.Lock()
+        self._keys: Optional[Dict[str, List[str]]] = None  # canonical key -> urls, built on first use
+        self._keys_lock = threading.Lock()
+        self._lock = RWLock()  # write side held by open batches
+        self._batching = False
 
+    @_reading
     def __len__(self):
-        return len(self.db)
+        return len(self.storage)
+
+    @contextmanager
+    def batch(self):
+        """
+        Group every write / update / delete done inside the block in a single
+        transaction, the database is written once when the block exits.
+        Duplicates are checked against both the database and the batch itself.
+        If an exception is raised nothing is committed.
+        """
+        with self._lock.write():
+            if self._batching:  # Nested batches join the outer one
+                yield self
+                return
+
+            self._batching = True
+            self.storage.begin()
+            try:
+                yield self
+                self.storage.commit()
+            except BaseException:
+                self.storage.rollback()
+                self._ranking = None  # They saw the changes rolled back
+                self._keys = None
+                raise
+            else:  # Committed, the texts of the deleted records can go
+                for url in self._unarchive:
+                    self.archive.remove(url)
+            finally:
+                # Results computed during the batch may have seen its changes
+                self.generation += 1
+                self._batching = False
+                self._unarchive = []
+
+    def _cached(self, key, compute, valid=None, extra=None) -> list:
+        """
+        Result of compute() through the query cache, see QueryCache.get for valid / extra
+        """
+        generation = self.generation  # Read before computing, a concurrent write makes it stale
+        result = self.queries.get(key, generation, valid)
+        if result is None:
+            result = compute()
+            self.queries.put(key, generation, result, extra)
+        return list(result)
+
+    def _key_index(self) -> Dict[str, List[str]]:
+        """
+        canonical key -> urls of the records having it, kept up to date by write / delete
+        """
+        with self._keys_lock:
+            if self._keys is None:
+                keys = defaultdict(list)
+                for doc in self.storage.iter_all():
+                    keys[self.canonical(doc['url'])].append(doc['url'])
+                self._keys = dict(keys)
+            return self._keys
+
+    def _duplicate_of(self, url: str) -> Optional[str]:
+        """
+        Url of the record that url duplicates (itself or one with the same canonical key), None if new
+        """
+        if url in self.storage:
+            return url
+        same = self._key_index().get(self.canonical(url))
+        return same[0] if same else None
+
+    @_reading
+    def get_canonical(self, url: str) -> Optional[Record]:
+        """
+        Get the record with the url passed or, failing that, one with the same canonical key.
+        Returns None if neither is in the database
+        """
+        same = self._duplicate_of(url)
+        return None if same is None else Record.from_doc(self.storage.get_url(same))
 
     def write(self, record: Records) -> List:
         """
-        Add records to database.
-        Raise error if there's a duplicate
+        Add records to database, a sequence is written in a single batch.
+        Raise error if there's a duplicate (same url or same canonical key)
         """
 
         if isinstance(record, Record):
             record = [record]
 
         res = []
-        for r in record:
-            if self.db.get(Q.url == r.url):
-                raise FileExistsError(f'The entry {r.url!r} already exists')
-            if r.ts is None:  # We do not allow entries without timestamp
-                r = replace(r, ts=time.time())
-            elif isinstance(r.ts, datetime):
-                r = replace(r, ts=datetime.timestamp(r.ts))
-
-            with transaction(self.db) as tr:
-                res.append(tr.insert(asdict(r)))
+        with self._lock.write():
+            # Checked before the batch, a duplicate must not roll back (and reload) the storage
+            seen = {}  # canonical key -> url, for the duplicates within the sequence
+            for r in record:
+                key = self.canonical(r.url)
+                same = self._duplicate_of(r.url) or seen.get(key)
+                if same == r.url:
+                    raise FileExistsError(f'The entry {r.url!r} already exists')
+                if same is not None:
+                    raise FileExistsError(f'The entry {r.url!r} already exists as {same!r}')
+                seen[key] = r.url
+
+            with self.batch():
+                keys = self._key_index()
+                for r in record:
+                    if r.ts is None:  # We do not allow entries without timestamp
+                        r = replace(r, ts=time.time())
+                    elif isinstance(r.ts, datetime):
+                        r = replace(r, ts=datetime.timestamp(r.ts))
+
+                    doc = r.to_doc()
+                    res.append(self.storage.insert(doc))
+                    keys.setdefault(self.canonical(r.url), []).append(r.url)
+                    if self._ranking is not None:
+                        self._ranking.add(doc)
         return res
 
-    def update_all(self) -> None:
+    def update_all(self, workers: int = 8, per_host: int = 2, batch_size: int = 50,
+                   progress=None) -> None:
         """
-        Update all records title and infos to the one you get from webscraping the site source
+        Update all records title and infos to the one you get from webscraping the site source.
+        Sites are fetched by a pool of `workers` threads with at most `per_host` requests
+        to the same host at once, results are committed every `batch_size` records.
+        progress(ith, total, record) is called as each result arrives, defaults to a print.
         """
-        total = len(self)
-        total_size = len(str(total))
-        for ith, r in enumerate(self.all()):  # This is inefficient but it's fine
-            url = sanitize_url(r.url)
-            print(f'{ith:{total_size}}/{total} {url}')
-            title, info = find_infos(url)
-            r_up = replace(r, url=url, title=title, info=info)
-            if url != r.url:
-                self.delete(r)
-                self.write(r_up)
+        records = self.all()
+
+        # Interleave the hosts so that workers are not all waiting on the same one
+        by_host = defaultdict(list)
+        for r in records:
+            by_host[urlparse(r.url).netloc].append(r)
+        records = [r for rs in zip_longest(*by_host.values()) for r in rs if r is not None]
+        self._refetch_all(records, workers, per_host, batch_size, progress)
+        return None
+
+    def refresh_stale(self, max_age: float = 60 * 60 * 24 * 30, budget: Optional[int] = None,
+                      backoff: Optional[HostBackoff] = None, workers: int = 8, per_host: int = 2,
+                      batch_size: int = 50, progress=None) -> Counter:
+        """
+        Refetch only the records that are due: never fetched, fetched more than
+        max_age seconds ago or failed and past their retry delay (see HostBackoff.delay).
+        The most overdue are fetched first, at most `budget` of them.
+        Hosts failing are skipped following the backoff (an in-memory one if None).
+        Results are committed every `batch_size` records and the fetch metadata is the
+        checkpoint: after a crash or restart the next run picks up what is still due.
+        Returns the counts of refreshed / failed / skipped (host backing off) / remaining records.
+        """
+        if backoff is None:
+            backoff = HostBackoff()
+        now = time.time()
+
+        def due(r):
+            if r.fetched is None:
+                return 0
+            if r.failures:
+                return r.fetched + min(max_age, backoff.delay(r.failures))
+            return r.fetched + max_age
+
+        stale = sorted((due(r), r.ts, r) for r in self.iter_all() if due(r) <= now)
+        counts = Counter(refreshed=0, failed=0, skipped=0)
+        records = []
+        for _, _, r in stale:
+            if budget is not None and len(records) >= budget:
+                break
+            if backoff.ready(urlparse(sanitize_url(r.url)).netloc):
+                records.append(r)
             else:
-                self.update(r_up)
+                counts['skipped'] += 1
+        counts['remaining'] = len(stale) - len(records) - counts['skipped']
+
+        def on_commit(results):
+            for r_up, ok in results:
+                counts['refreshed' if ok else 'failed'] += 1
+            backoff.save()
+
+        def on_skip(r):  # Its host started failing during the run
+            counts['skipped'] += 1
+        self._refetch_all(records, workers, per_host, batch_size, progress, backoff, on_commit, on_skip)
+        return counts
+
+    def _refetch_all(self, records, workers, per_host, batch_size, progress,
+                     backoff: Optional[HostBackoff] = None, on_commit=None, on_skip=None) -> None:
+        """
+        Fetch records again in a thread pool and commit them with the fetch metadata
+        `batch_size` at a time, records of hosts backing off meanwhile are skipped
+        (and passed to on_skip). Only connection errors, 429 and 5xx count against a host,
+        a 4xx is a problem of the page and only counts in the failures of its record.
+        """
+        total = len(records)
+        total_size = len(str(total))
+        if progress is None:
+            def progress(ith, total, r):
+                print(f'{ith:{total_size}}/{total} {r.url}')
+
+        host_locks = defaultdict(lambda: threading.BoundedSemaphore(per_host))
+        host_locks_lock = threading.Lock()
+
+        def fetch_one(r):
+            host = urlparse(sanitize_url(r.url)).netloc
+            with host_locks_lock:
+                host_lock = host_locks[host]
+            with host_lock:
+                if backoff is not None and not backoff.ready(host):
+                    return None
+                r_up, ok = self._refetch(r)
+            if backoff is not None:
+                if not ok and (r_up.status in (0, 429) or r_up.status >= 500):
+                    backoff.failed(host)
+                else:
+                    backoff.succeeded(host)
+            return r_up, ok
+
+        def commit(pending):
+            self._commit_updates([(r, r_up) for r, (r_up, ok) in pending])
+            if on_commit is not None:
+                on_commit([result for _, result in pending])
+
+        pending = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch_one, r): r for r in records}
+            for ith, future in enumerate(as_completed(futures)):
+                result = future.result()
+                if result is None:
+                    if on_skip is not None:
+                        on_skip(futures[future])
+                    continue
+                progress(ith, total, result[0])
+                pending.append((futures[future], result))
+                if len(pending) >= batch_size:
+                    commit(pending)
+                    pending = []
+        commit(pending)
         return None
 
+    def _refetch(self, r: Record):
+        """
+        Scrape the site of r again, returns the updated record and whether the fetch worked.
+        Title and info are kept if the site does not provide them.
+        """
+        url = sanitize_url(r.url)
+        archive = self.archive
+        # A conditional request answered by a 304 has no text, only use it if the text is archived
+        cache = self.cache if archive is None or url in archive else None
+        res = fetch(url, cache, revalidate=True, text=archive is not None)
+        now = time.time()
+        if not res.ok or (res.status or 0) >= 400:  # The archived text, if any, is kept
+            return replace(r, url=url, fetched=now, status=res.status or 0,
+                           failures=(r.failures or 0) + 1), False
+        if archive is not None and res.text is not None:
+            archive.put(url, res.text)
+        return replace(r, url=url,
+                       title=r.title if res.title is None else res.title,
+                       info=r.info if res.info is None else res.info,
+                       fetched=now, status=res.status, failures=0), True
+
+    def _commit_updates(self, pending) -> None:
+        """
+        Commit (old record, updated record) pairs in a single batch.
+        If the url changed the old record is replaced, or merged into the
+        record that already uses the new url (or its canonical key).
+        Records deleted while they were fetched are skipped.
+        """
+        with self.batch():
+            for r, r_up in pending:
+                if r_up.url == r.url:
+                    self.update(r_up)
+                    continue
+                if r.url not in self.storage:
+                    continue
+                self.delete(r)
+                same = self._duplicate_of(r_up.url)
+                if same is not None:
+                    self.update(replace(r_up, url=same, ts=None))
+                else:
+                    self.write(r_up)
+
+    @_reading
     def search(self, q) -> Optional[List[Record]]:
         """
         Utility function to have search queries return Record objects
         """
-        results = self.db.search(q)
-        return [Record(**r) for r in results]
+        def compute():
+            return [Record.from_doc(r) for r in self.storage.search(q)]
+
+        if not getattr(q, 'is_cacheable', lambda: False)():  # Arbitrary callables are not cached
+            return compute()
+        return self._cached(('search', q), compute)
+
+    @_reading
+    def search_text(self, *keywords: str) -> List[Record]:
+        """
+        Keyword search over title, url and info using the storage text index.
+        A record matches if every keyword is a prefix of one of its tokens.
+        With no keywords every record is returned.
+        """
+        tokens = frozenset(t for k in keywords for t in tokenize(k))
+        return self._cached(('search_text', tokens), lambda: list(self.iter_text(*tokens)))
+
+    @_reading
+    def search_ranked(self, *keywords: str, k: int = 10) -> List[Record]:
+        """
+        The k records that best match the keywords (BM25 over title, url and info,
+        title weighted more), best first. A record matches if it has any keyword,
+        keywords match the tokens they are a prefix of as in search_text.
+        The index is built on the first call and kept up to date by the writes.
+        """
+        tokens = frozenset(t for kw in keywords for t in tokenize(kw))
+        if not tokens or k <= 0:
+            return []
+        return self._cached(('search_ranked', tokens, k), lambda: self._rank(tokens, k))
+
+    def _rank(self, tokens, k) -> List[Record]:
+        with self._ranking_lock:  # Writes are held off by the read lock
+            ranking = self._ranking
+            if ranking is None or ranking.needs_rebuild:
+                ranking = BM25Index()
+                ranking.build(self.storage.iter_all())
+                self._ranking = ranking
+        res = []
+        for url, _ in ranking.top(tokens, k):
+            doc = self.storage.get_url(url)
+            if doc is not None:
+                res.append(Record.from_doc(doc))
+        return res
+
+    def _page(self, docs: Iterable[dict], limit: Optional[int], offset: int) -> Iterator[Record]:
+        stop = None if limit is None else offset + limit
+        for r in islice(self._locked(docs), offset, stop):
+            yield Record.from_doc(r)
+
+    def _locked(self, docs: Iterable[dict], chunk: int = 64) -> Iterator[dict]:
+        """
+        Pull docs `chunk` at a time holding the read lock, writes can happen
+        between chunks (and may or may not be seen) but never during one
+        """
+        docs = iter(docs)
+        while True:
+            with self._lock.read():
+                batch = list(islice(docs, chunk))
+            if not batch:
+                return
+            yield from batch
+
+    @staticmethod
+    def _check_order(order: str) -> None:
+        if order not in ORDERS:
+            raise ValueError(f'Unknown order {order!r}, use one of {ORDERS}')
+
+    def iter_all(self, limit: Optional[int] = None, offset: int = 0,
+                 order: str = 'id') -> Iterator[Record]:
+        """
+        Lazily yield the records, stops once `limit` records are yielded.
+        order is 'id' (insertion order), 'ts' (oldest first) or '-ts' (newest first)
+        """
+        self._check_order(order)
+        return self._page(self.storage.iter_all(order), limit, offset)
+
+    def iter_search(self, q, limit: Optional[int] = None, offset: int = 0,
+                    order: str = 'id') -> Iterator[Record]:
+        """
+        Lazy version of search, same arguments as iter_all
+        """
+        self._check_order(order)
+        return self._page((r for r in self.storage.iter_all(order) if q(r)), limit, offset)
+
+    def iter_text(self, *keywords: str, limit: Optional[int] = None, offset: int = 0,
+                  order: str = 'id') -> Iterator[Record]:
+        """
+        Lazy version of search_text, same arguments as iter_all
+        """
+        self._check_order(order)
+        tokens = set()
+        for k in keywords:
+            tokens.update(tokenize(k))
+        if not tokens:
+            return self._page(self.storage.iter_all(order), limit, offset)
+        return self._page(self.storage.iter_text(tokens, order), limit, offset)
 
+    @_reading
     def get(self, q) -> Optional[Record]:
         """
         Utility function to have get queries return Record objects
         Returns None if the query does not match anything
         """
-        result = self.db.get(q)
+        result = self.storage.get(q)
         if result is None:
             return None
-        return Record(**result)
-    
+        return Record.from_doc(result)
+
+    @_reading
+    def get_url(self, url: str) -> Optional[Record]:
+        """
+        Get the record with the url passed using the url index.
+        Returns None if the url is not in the database
+        """
+        result = self.storage.get_url(url)
+        if result is None:
+            return None
+        return Record.from_doc(result)
+
+    @_reading
+    def search_pages(self, *keywords: str, k: int = 10) -> List[Record]:
+        """
+        The k records whose archived page text has every keyword (or a word starting with it),
+        best BM25 match first. Empty without an archive
+        """
+        if self.archive is None:
+            return []
+        records = []
+        for url, _ in self.archive.search(keywords, k):
+            doc = self.storage.get_url(url)
+            if doc is not None:
+                records.append(Record.from_doc(doc))
+        return records
+
+    def page_text(self, url: str) -> Optional[str]:
+        """
+        Archived text of the page of url, None if not archived (or no archive)
+        """
+        return None if self.archive is None else self.archive.get(sanitize_url(url))
+
+    @_reading
+    def __contains__(self, url: str) -> bool:
+        return url in self.storage
+
     def delete(self, record: Record) -> None:
         """
         Delete a record
+        Raise error if the url does not exist
         """
-        with transaction(self.db) as tr:
-            return tr.remove(Q.url == record.url)
+        with self._lock.write():
+            if record.url not in self.storage:  # Checked before the batch, nothing to roll back
+                raise FileNotFoundError(f'The entry {record.url!r} does not exist')
+            with self.batch():
+                self.storage.delete(record.url)
+                if self._ranking is not None:
+                    self._ranking.remove(record.url)
+                if self.archive is not None:
+                    self._unarchive.append(record.url)
+                if self._keys is not None:
+                    key = self.canonical(record.url)
+                    urls = [u for u in self._keys.get(key, ()) if u != record.url]
+                    if urls:
+                        self._keys[key] = urls
+                    else:
+                        self._keys.pop(key, None)
+        return None
 
-    def smatch(self, record: Record) -> Optional[List[Record]]:
+    def dedupe(self, follow_redirects: bool = True) -> Counter:
         """
-        Search for any entry that match a Record, only intialized (not None) fields are used
+        Merge the records sharing a canonical key, in one pass over the database and one batch.
+        With follow_redirects a url whose redirect target is known by the fetch cache is keyed
+        by the target (no request is made). The oldest record of each group is kept and its
+        missing title / info are taken from the others, newest last.
+        Returns the counts of groups merged and records removed.
         """
-        return self.search(Q.fragment(record.query_dict()))
+        counts = Counter(groups=0, removed=0)
+        with self.batch():
+            groups = defaultdict(list)
+            for doc in self.storage.iter_all('ts'):
+                url = doc['url']
+                if follow_redirects and self.cache is not None:
+                    entry = self.cache.get(url)
+                    url = url if entry is None else entry['url']
+                groups[self.canonical(url)].append((doc['url'], doc['title'], doc['info']))
 
-    def stime(self, start: OptTimeType = None, end: OptTimeType = None) -> Optional[List]:
+            for docs in groups.values():
+                if len(docs) < 2:
+                    continue
+                (url, title, info), rest = docs[0], docs[1:]
+                for other, other_title, other_info in rest:
+                    title = other_title if title is None else title
+                    info = other_info if info is None else info
+                    self.delete(Record(url=other))
+                self.update(Record(url=url, title=title, info=info))
+                counts['groups'] += 1
+                counts['removed'] += len(rest)
+        return counts
+
+    @_reading
+    def smatch(self, record: Record) -> Optional[List[Record]]:
         """
-        Search in the interval of time provided.
-        Use datetime objects or timestamps,
-        if start not provided it is the epoch
-        if end not provided it is current timestamp
+        Search for any entry that match a Record, only intialized (not None) fields are used
         """
+        fields = record.query_dict()
+        return self._cached(('smatch', tuple(sorted(fields.items()))),
+                            lambda: [Record.from_doc(r) for r in self.storage.match(fields)])
+
+    @staticmethod
+    def _time_bounds(start: OptTimeType, end: OptTimeType):
         if isinstance(start, datetime):
             start = datetime.timestamp(start)
         elif start is None:
@@ -163,23 +1018,240 @@ class Bookmarket:
             end = datetime.timestamp(end)
         elif end is None:
             end = time.time()
+        return start, end
 
-        return self.search((Q.ts >= start) & (Q.ts < end))
+    @_reading
+    def stime(self, start: OptTimeType = None, end: OptTimeType = None) -> Optional[List]:
+        """
+        Search in the interval of time provided.
+        Use datetime objects or timestamps,
+        if start not provided it is the epoch
+        if end not provided it is current timestamp
+        """
+        start_ts, end_ts = self._time_bounds(start, end)
+
+        def compute():
+            return list(self.iter_stime(start_ts, end_ts))
+
+        if end is not None:
+            return self._cached(('stime', start_ts, end_ts), compute)
+
+        # Open ended: the result computed until `until` holds as long as
+        # nothing was added between then and now
+        def valid(until):
+            return self.storage.count_time(until, end_ts) == 0
+        return self._cached(('stime', start_ts, None), compute, valid, extra=end_ts)
+
+    def iter_stime(self, start: OptTimeType = None, end: OptTimeType = None, limit: Optional[int] = None,
+                   offset: int = 0, reverse: bool = False) -> Iterator[Record]:
+        """
+        Lazy version of stime, sorted by ts (newest first with reverse)
+        """
+        docs = self.storage.iter_time_range(*self._time_bounds(start, end), reverse=reverse)
+        return self._page(docs, limit, offset)
+
+    @_reading
+    def count_time(self, start: OptTimeType = None, end: OptTimeType = None) -> int:
+        """
+        Number of records in the interval of time provided, same arguments as stime.
+        Does not build any Record.
+        """
+        return self.storage.count_time(*self._time_bounds(start, end))
 
     def update(self, record: Record):
         """
         Update entry that matches the record url passed.
         Will only update record initialized fields.
+        Returns False if the url does not exist.
         """
-        with transaction(self.db) as tr:
-            tr.update(record.query_dict(), Q.url == record.url)
-        return None
+        with self.batch():
+            found = self.storage.update(record.url, record.query_dict())
+            if found and self._ranking is not None:
+                self._ranking.add(self.storage.get_url(record.url))
+            return found
 
+    @_reading
     def all(self) -> List[Record]:
-        return [Record(**r) for r in self.db.all()]
+        return list(self.iter_all())
+
+    def import_bookmarks(self, f, fmt: Optional[str] = None,
+                         enricher: Optional['Enricher'] = None) -> Counter:
+        """
+        Add the bookmarks of a file (path or open text file) exported by a browser,
+        fmt is one of formats.FORMATS, guessed from the content if None.
+        The file is parsed as it is read and everything is committed in a single batch.
+        Urls are sanitized, the ones already in the database (or repeated, also by
+        canonical key) and the non http ones are skipped. Urls missing title or info are queued on the enricher.
+        Returns the counts of added / duplicates / skipped bookmarks.
+        """
+        if isinstance(f, str):
+            with open(f, 'r', encoding='utf-8', errors='replace') as fp:
+                return self.import_bookmarks(fp, fmt, enricher)
+
+        counts = Counter(added=0, duplicates=0, skipped=0)
+        to_enrich = []
+        with self.batch():
+            for doc in formats.read(f, fmt):
+                url = sanitize_url(doc['url'].strip())
+                if urlparse(url).scheme not in ('http', 'https'):
+                    counts['skipped'] += 1
+                    continue
+                if self._duplicate_of(url) is not None:
+                    counts['duplicates'] += 1
+                    continue
+                r = Record.from_doc({**doc, 'url': url})
+                self.write(r)
+                counts['added'] += 1
+                if r.title is None or r.info is None:
+                    to_enrich.append(url)
+        if enricher is not None:
+            enricher.extend(to_enrich)
+        return counts
+
+    def export_bookmarks(self, f, fmt: str = 'html') -> int:
+        """
+        Write every record (oldest first) to a file (path or open text file)
+        in one of formats.FORMATS, records are streamed from the database.
+        Returns the number of records written.
+        """
+        if isinstance(f, str):
+            with open(f, 'w', encoding='utf-8') as fp:
+                return self.export_bookmarks(fp, fmt)
+        return formats.write(f, self._locked(self.storage.iter_all('ts')), fmt)
+
+    def size_on_disk(self) -> int:
+        """
+        Bytes used by the database files (including the sqlite WAL and the log snapshot)
+        """
+        paths = [self.path + suffix for suffix in ('', '-wal', '-shm', '.snapshot', '.old')]
+        return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
 
     def truncate(self):
-        self.db.truncate()
+        with self._lock.write():
+            self.storage.truncate()
+            self.generation += 1
+            self._ranking = None
+            self._keys = None
 
     def close(self):
-        self.db.close()
+        self.storage.close()
+        if self.cache is not None:
+            self.cache.save()
+        if self.archive is not None:
+            self.archive.close()
+
+
+class Enricher:
+    """
+    Background worker that fills title / info of the records missing them,
+    so nothing has to be scraped while answering a search.
+    Urls are queued once, the queue is saved in `path` so pending work survives
+    a restart and the results are written `batch_size` at a time.
+    """
+    def __init__(self, bm: Bookmarket, path: Optional[str] = None, batch_size: int = 20,
+                 workers: int = 4):
+        self.bm = bm
+        self.path = path
+        self.batch_size = batch_size
+        self.workers = workers
+        self._queue = OrderedDict()  # url -> None, ordered set
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = False
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self._queue.update(dict.fromkeys(json.load(f)))
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _save(self) -> None:
+        if self.path is None:
+            return None
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(list(self._queue), f)
+        os.replace(tmp, self.path)
+        return None
+
+    def add(self, url: str) -> bool:
+        """
+        Queue url, returns False if it was already queued
+        """
+        with self._cond:
+            if url in self._queue:
+                return False
+            self._queue[url] = None
+            self._save()
+            self._cond.notify()
+        return True
+
+    def extend(self, urls: Iterable[str]) -> int:
+        """
+        Queue many urls saving the queue once, returns how many were new
+        """
+        with self._cond:
+            n = len(self._queue)
+            self._queue.update(dict.fromkeys(urls))
+            added = len(self._queue) - n
+            if added:
+                self._save()
+                self._cond.notify()
+        return added
+
+    def _enrich(self, url: str) -> Optional[Record]:
+        r = self.bm.get_url(url)
+        if r is None or (r.title is not None and r.info is not None):
+            return None
+        title, info = find_infos(sanitize_url(url), self.bm.cache)
+        return Record(url=url,
+                      title=title if r.title is None else None,
+                      info=info if r.info is None else None)
+
+    def process(self) -> int:
+        """
+        Enrich one batch of queued urls, returns how many were processed
+        """
+        with self._cond:
+            urls = list(islice(self._queue, self.batch_size))
+        if not urls:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            updates = [r for r in pool.map(self._enrich, urls) if r is not None]
+        with self.bm.batch():
+            for r in updates:
+                if r.title is not None or r.info is not None:
+                    self.bm.update(r)
+
+        with self._cond:  # Only now the work is done and can leave the queue
+            for url in urls:
+                self._queue.pop(url, None)
+            self._save()
+        return len(urls)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return None
+            try:
+                self.process()
+            except Exception:  # Keep the worker alive, the batch stays queued
+                logger.exception('Enricher failed a batch')
+                time.sleep(5)
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,110 @@
+"""
+Canonical keys of urls: the same page saved as http://www.site.com/page/,
+https://site.com/page?utm_source=x or https://site.com/page#top gets the key
+https://site.com/page. The key is only used to find duplicates, records keep the url
+they were saved with.
+The pipeline is a sequence of steps (names of STEPS or functions) applied to
+the parsed url, Canonicalizer(steps=...) picks which ones run.
+"""
+from typing import Callable, Iterable, Sequence, Union
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, SplitResult
+
+# Query parameters that only track where a click came from
+TRACKING_PARAMS = frozenset((
+    'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', 'igshid',
+    'ref', 'ref_src', 'ref_url', 'si', '_hsenc', '_hsmi', 'spm',
+))
+TRACKING_PREFIXES = ('utm_', 'pk_', 'hsa_')
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+
+def _host(parts: SplitResult, canon) -> SplitResult:
+    return parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower())
+
+
+def _port(parts: SplitResult, canon) -> SplitResult:
+    host, _, port = parts.netloc.rpartition(':')
+    if host and port == DEFAULT_PORTS.get(parts.scheme):
+        return parts._replace(netloc=host)
+    return parts
+
+
+def _www(parts: SplitResult, canon) -> SplitResult:
+    if parts.netloc.startswith('www.'):
+        return parts._replace(netloc=parts.netloc[4:])
+    return parts
+
+
+def _scheme(parts: SplitResult, canon) -> SplitResult:
+    # http and https serve the same page nowadays
+    if parts.scheme == 'http':
+        return parts._replace(scheme='https')
+    return parts
+
+
+def _fragment(parts: SplitResult, canon) -> SplitResult:
+    return parts._replace(fragment='')
+
+
+def _tracking(parts: SplitResult, canon) -> SplitResult:
+    if not parts.query:
+        return parts
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k.lower() not in canon.tracking and not k.lower().startswith(TRACKING_PREFIXES)]
+    return parts._replace(query=urlencode(query))
+
+
+def _query_order(parts: SplitResult, canon) -> SplitResult:
+    if not parts.query:
+        return parts
+    return parts._replace(query=urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True))))
+
+
+def _trailing_slash(parts: SplitResult, canon) -> SplitResult:
+    path = parts.path.rstrip('/')
+    for index in ('/index.html', '/index.htm', '/index.php'):
+        if path.endswith(index):
+            path = path[:-len(index)]
+    return parts._replace(path=path)
+
+
+def _arxiv(parts: SplitResult, canon) -> SplitResult:
+    # Same rule as sanitize_url: the pdf of a paper is the paper
+    if parts.netloc.endswith('arxiv.org') and parts.path.startswith('/pdf/'):
+        path = '/abs/' + parts.path[len('/pdf/'):]
+        return parts._replace(path=path[:-len('.pdf')] if path.endswith('.pdf') else path)
+    return parts
+
+
+STEPS = {
+    'host': _host,
+    'port': _port,
+    'www': _www,
+    'scheme': _scheme,
+    'fragment': _fragment,
+    'tracking': _tracking,
+    'query_order': _query_order,
+    'trailing_slash': _trailing_slash,
+    'arxiv': _arxiv,
+}
+DEFAULT_STEPS = tuple(STEPS)
+Step = Union[str, Callable[[SplitResult, 'Canonicalizer'], SplitResult]]
+
+
+class Canonicalizer:
+    """
+    Callable turning a url in its canonical key.
+    steps run in order, tracking is the set of query parameters dropped by the 'tracking' step.
+    """
+    def __init__(self, steps: Sequence[Step] = DEFAULT_STEPS, tracking: Iterable[str] = TRACKING_PARAMS):
+        unknown = [s for s in steps if isinstance(s, str) and s not in STEPS]
+        if unknown:
+            raise ValueError(f'Unknown canonicalization steps {unknown}, use {list(STEPS)}')
+        self.steps = [STEPS[s] if isinstance(s, str) else s for s in steps]
+        self.tracking = frozenset(t.lower() for t in tracking)
+
+    def __call__(self, url: str) -> str:
+        parts = urlsplit(url.strip())
+        for step in self.steps:
+            parts = step(parts, self)
+        return urlunsplit(parts)
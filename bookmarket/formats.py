@@ -0,0 +1,262 @@
+"""
+Streaming readers and writers of the bookmark files browsers import / export:
+Netscape bookmark html (every browser), Chrome and Firefox json backups
+and plain url lists (one url per line, optionally followed by a title).
+Files are read `CHUNK_SIZE` characters at a time and documents (dicts with
+url, title, info, ts) are yielded as soon as they are parsed.
+"""
+from html.parser import HTMLParser
+from html import escape
+from json.decoder import scanstring, JSONDecodeError
+from typing import IO, Iterable, Iterator, Optional
+import json
+import re
+CHUNK_SIZE = 64 * 1024
+FORMATS = ('html', 'json', 'urls')
+CHROME_EPOCH = 11644473600  # seconds between 1601-01-01 (chrome timestamps) and 1970-01-01
+_SCALAR_RE = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?|true|false|null')
+
+
+def _chunks(f: IO[str]) -> Iterator[str]:
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def sniff(f: IO[str]) -> str:
+    """
+    Guess the format of a file from its first characters, the file position is restored
+    """
+    pos = f.tell()
+    head = f.read(1024).lstrip()
+    f.seek(pos)
+    if head.startswith('<'):
+        return 'html'
+    if head.startswith(('{', '[')):
+        return 'json'
+    return 'urls'
+
+
+def read(f: IO[str], fmt: Optional[str] = None) -> Iterator[dict]:
+    """
+    Documents of the bookmark file f, fmt is one of FORMATS (guessed if None)
+    """
+    fmt = fmt or sniff(f)
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}, use one of {FORMATS}')
+    return {'html': read_html, 'json': read_json, 'urls': read_urls}[fmt](f)
+
+
+class _NetscapeParser(HTMLParser):
+    """
+    <DT><A HREF=url ADD_DATE=ts>title</A> optionally followed by <DD>description.
+    Parsed documents are appended to done.
+    """
+    def __init__(self):
+        super().__init__()
+        self.done = []
+        self._doc = None  # link waiting for a possible <DD>
+        self._text = None  # collecting the text of a title / description
+        self._field = None
+
+    def _flush(self):
+        if self._doc is not None:
+            if self._field == 'info':
+                self._doc['info'] = self._text.strip() or None
+            self.done.append(self._doc)
+        self._doc = self._text = self._field = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._flush()
+            attrs = dict(attrs)
+            if attrs.get('href'):
+                try:
+                    ts = float(attrs['add_date'])
+                except (KeyError, TypeError, ValueError):
+                    ts = None
+                self._doc = {'url': attrs['href'], 'title': None, 'info': None, 'ts': ts}
+                self._text, self._field = '', 'title'
+        elif tag == 'dd' and self._doc is not None:
+            self._text, self._field = '', 'info'
+        elif tag in ('dt', 'dl', 'h3'):
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._field == 'title':
+            self._doc['title'] = self._text.strip() or None
+            self._text = self._field = None
+        elif tag == 'dl':
+            self._flush()
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text += data
+
+
+def read_html(f: IO[str]) -> Iterator[dict]:
+    parser = _NetscapeParser()
+    for chunk in _chunks(f):
+        parser.feed(chunk)
+        yield from parser.done
+        parser.done.clear()
+    parser.close()
+    parser._flush()
+    yield from parser.done
+
+
+def _json_doc(node) -> Optional[dict]:
+    """
+    Document of a Chrome ({'type': 'url', 'url', 'name', 'date_added'}) or
+    Firefox ({'uri', 'title', 'dateAdded'}) bookmark node, None for folders and the rest
+    """
+    if not isinstance(node, dict):
+        return None
+    try:
+        if node.get('type') == 'url' and node.get('url'):
+            ts = int(node['date_added']) / 1e6 - CHROME_EPOCH if node.get('date_added') else None
+            return {'url': node['url'], 'title': node.get('name') or None, 'info': None, 'ts': ts}
+        if node.get('uri'):
+            ts = node['dateAdded'] / 1e6 if node.get('dateAdded') else None
+            return {'url': node['uri'], 'title': node.get('title') or None, 'info': None, 'ts': ts}
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def _iter_children(f: IO[str]) -> Iterator:
+    """
+    Items of every "children" array of a json file, these arrays are never
+    built so only the folders being parsed are kept in memory.
+    """
+    chunks = _chunks(f)
+    buf, pos, eof = '', 0, False
+    # [object, key of the value being parsed] or [array, whether its items are streamed]
+    stack = []
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            buf, pos = buf[pos:] + chunk, 0
+
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,:':
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                return
+            more()
+            continue
+
+        c = buf[pos]
+        if c in '{[':
+            streamed = (c == '[' and len(stack) > 0 and isinstance(stack[-1][0], dict)
+                        and stack[-1][1] == 'children')
+            stack.append([{} if c == '{' else [], streamed if c == '[' else None])
+            pos += 1
+            continue
+        if c in '}]':
+            value = stack.pop()[0]
+            pos += 1
+        elif c == '"':
+            try:
+                value, end = scanstring(buf, pos + 1)
+            except JSONDecodeError:
+                if eof:
+                    raise
+                more()
+                continue
+            if end >= len(buf) and not eof:  # Might be a key whose ':' is not read yet
+                more()
+                continue
+            pos = end
+            if stack and isinstance(stack[-1][0], dict) and stack[-1][1] is None:
+                stack[-1][1] = value  # A key
+                continue
+        else:
+            m = _SCALAR_RE.match(buf, pos)
+            if m is None or (m.end() >= len(buf) and not eof):
+                if m is None and eof:
+                    raise ValueError(f'Invalid json at {buf[pos:pos + 20]!r}')
+                more()
+                continue
+            value = json.loads(m.group())
+            pos = m.end()
+
+        if not stack:
+            return
+        parent = stack[-1]
+        if isinstance(parent[0], dict):
+            parent[0][parent[1]] = value
+            parent[1] = None
+        elif parent[1]:
+            yield value
+        else:
+            parent[0].append(value)
+
+
+def read_json(f: IO[str]) -> Iterator[dict]:
+    for node in _iter_children(f):
+        doc = _json_doc(node)
+        if doc is not None:
+            yield doc
+
+
+def read_urls(f: IO[str]) -> Iterator[dict]:
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        url, _, title = line.partition(' ')
+        yield {'url': url, 'title': title.strip() or None, 'info': None, 'ts': None}
+
+
+def write(f: IO[str], docs: Iterable[dict], fmt: str) -> int:
+    """
+    Write docs to f in one of FORMATS, one document at a time. Returns how many were written
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}, use one of {FORMATS}')
+    return {'html': write_html, 'json': write_json, 'urls': write_urls}[fmt](f, docs)
+
+
+def write_html(f: IO[str], docs: Iterable[dict]) -> int:
+    f.write('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+            '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+            '<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n')
+    n = 0
+    for n, doc in enumerate(docs, 1):
+        add_date = f' ADD_DATE="{int(doc["ts"])}"' if doc.get('ts') is not None else ''
+        title = escape(doc.get('title') or '')
+        f.write(f'    <DT><A HREF="{escape(doc["url"])}"{add_date}>{title}</A>\n')
+        if doc.get('info'):
+            f.write(f'    <DD>{escape(doc["info"])}\n')
+    f.write('</DL><p>\n')
+    return n
+
+
+def write_json(f: IO[str], docs: Iterable[dict]) -> int:
+    """
+    Chrome bookmarks file with every document in the bookmark bar
+    """
+    f.write('{"roots": {"bookmark_bar": {"type": "folder", "name": "Bookmarks bar", "children": [\n')
+    n = 0
+    for n, doc in enumerate(docs, 1):
+        node = {'type': 'url', 'url': doc['url'], 'name': doc.get('title') or ''}
+        if doc.get('ts') is not None:
+            node['date_added'] = str(int((doc['ts'] + CHROME_EPOCH) * 1e6))
+        f.write((',\n' if n > 1 else '') + json.dumps(node))
+    f.write('\n]}}, "version": 1}\n')
+    return n
+
+
+def write_urls(f: IO[str], docs: Iterable[dict]) -> int:
+    n = 0
+    for n, doc in enumerate(docs, 1):
+        f.write(doc['url'] + '\n')
+    return n
@@ -0,0 +1,139 @@
+"""
+Bounded pool for the slow bot handlers (scraping, bulk updates) so that
+they never block the dispatcher, with a concurrency limit for each kind
+of job and a status table of the recent jobs.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+import threading
+import inspect
+import logging
+import itertools
+import time
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    desc: str
+    state: str = 'queued'  # queued -> running -> done / failed (or cancelled)
+    progress: Optional[str] = None
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    owner: Optional[int] = None  # chat that submitted the job
+    future: Optional[Future] = field(default=None, repr=False)
+
+    def __str__(self):
+        elapsed = (self.finished or time.time()) - (self.started or self.submitted)
+        msg = f'#{self.id} {self.kind} {self.state} {elapsed:.0f}s {self.desc}'
+        return msg if self.progress is None else f'{msg} ({self.progress})'
+
+
+class Jobs:
+    """
+    Run jobs on `workers` threads, at most limits[kind] jobs of a kind run
+    at once. The others wait queued outside the pool, so they never hold a
+    worker that jobs of other kinds could use. The last `history` jobs are kept for status().
+    """
+    def __init__(self, workers: int = 8, limits: Optional[Dict[str, int]] = None, history: int = 50):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.limits = dict(limits or {})
+        self.history = history
+        self._jobs = OrderedDict()  # id -> Job
+        self._ids = itertools.count(1)
+        self._running = defaultdict(int)  # kind -> jobs of the kind in the pool
+        self._pending = defaultdict(deque)  # kind -> (job, fn, args, kwargs) waiting for a free slot
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)  # notified when a kind has nothing left to run
+
+    def submit(self, kind: str, desc: str, fn: Callable, *args, owner: Optional[int] = None, **kwargs) -> Job:
+        """
+        Run fn(*args, **kwargs) in the pool. If fn accepts a `job` keyword it is
+        passed the Job so it can report its progress
+        """
+        job = Job(next(self._ids), kind, desc, owner=owner, future=Future())
+        if 'job' in inspect.signature(fn).parameters:
+            kwargs['job'] = job
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.finished is None:  # Never forget running jobs
+                    break
+                self._jobs.popitem(last=False)
+            limit = self.limits.get(kind)
+            start = limit is None or self._running[kind] < limit
+            if start:
+                self._running[kind] += 1
+            else:
+                self._pending[kind].append((job, fn, args, kwargs))
+        if start:
+            self.pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        try:
+            if not job.future.set_running_or_notify_cancel():
+                job.state = 'cancelled'
+                return None
+            job.state = 'running'
+            job.started = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                job.state = 'failed'
+                logger.exception(f'Job {job} failed')
+                job.future.set_exception(e)
+            else:
+                job.state = 'done'
+                job.future.set_result(result)
+        finally:
+            job.finished = time.time()
+            self._next(job.kind)
+        return None
+
+    def _next(self, kind: str) -> None:
+        """
+        A job of kind is over, hand its slot to the next one waiting
+        """
+        with self._lock:
+            if self._pending[kind]:
+                waiting = self._pending[kind].popleft()
+            else:
+                self._running[kind] -= 1
+                self._idle.notify_all()
+                return None
+        self.pool.submit(self._run, *waiting)
+        return None
+
+    def status(self, active_only: bool = False, owner: Optional[int] = None) -> List[Job]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if owner is not None:
+            jobs = [j for j in jobs if j.owner == owner]
+        if active_only:
+            jobs = [j for j in jobs if j.finished is None]
+        return jobs
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop the pool, with wait every job (queued ones included) runs first,
+        without the queued jobs are cancelled
+        """
+        if wait:
+            with self._idle:  # Queued jobs are handed to the pool by the ones finishing
+                self._idle.wait_for(lambda: not any(self._running.values()))
+        else:
+            with self._lock:
+                waiting = [w for queue in self._pending.values() for w in queue]
+                self._pending.clear()
+            for job, *_ in waiting:
+                job.future.cancel()
+                job.state = 'cancelled'
+                job.finished = time.time()
+        self.pool.shutdown(wait=wait)
@@ -0,0 +1,75 @@
+"""
+Readers-writer lock used by Bookmarket: any number of threads can read at
+once while writes (batches) get the database for themselves.
+"""
+from contextlib import contextmanager
+import threading
+
+
+class RWLock:
+    """
+    Many readers or a single writer. A writer waiting stops new readers from
+    coming in, so a stream of searches can't starve a commit.
+    Both sides are reentrant and the writer can also read, but a reader can't
+    become a writer (two readers doing it would wait on each other forever).
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None  # ident of the thread writing
+        self._writes = 0  # reentrant depth of the writer
+        self._waiting_writers = 0
+        self._local = threading.local()  # .reads: read depth of the thread
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, 'reads', 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.reads = depth + 1
+            try:
+                yield
+            finally:
+                self._local.reads = depth
+            return
+
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._writes += 1
+            try:
+                yield
+            finally:
+                self._writes -= 1
+            return
+        if getattr(self._local, 'reads', 0):
+            raise RuntimeError('A reader can not acquire the write lock')
+
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
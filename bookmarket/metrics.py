@@ -0,0 +1,276 @@
+"""
+Opt-in instrumentation: counters, latency histograms and gauges rendered in
+the Prometheus text format (render) or as a short summary (summary).
+METRICS is disabled by default, then inc / observe return at once and the
+Bookmarket methods are not wrapped at all, so there is no cost to pay.
+
+    METRICS.enable()
+    METRICS.instrument(bm)  # time the Bookmarket operations
+    METRICS.serve(9108)  # optional http://127.0.0.1:9108/metrics endpoint
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from functools import wraps
+from bisect import bisect_left
+import threading
+import logging
+import time
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Eager Bookmarket methods timed by instrument, lazy iter_* methods would only time the generator creation
+BOOKMARKET_OPS = ('write', 'update', 'delete', 'get', 'get_url', 'search', 'search_text', 'search_ranked',
+                  'smatch', 'stime', 'count_time', 'all', 'truncate', 'update_all', 'refresh_stale',
+                  'dedupe', 'search_pages')
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Approximate quantile, the upper bound of the bucket that holds it
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _labels(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = ','.join(f'{k}="{v}"' for k, v in labels)
+    return '{' + labels + '}' if labels else ''
+
+
+class Metrics:
+    """
+    Registry of the metrics, metrics are identified by name and labels.
+    Gauges are callbacks read at render time, a callback can return a number
+    or a dict {label value: number} that is rendered with the gauge `label`.
+    """
+    def __init__(self, enabled: bool = False, buckets: Tuple[float, ...] = BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.help: Dict[str, str] = {}
+        self._counters: Dict[Tuple, float] = {}  # (name, labels) -> value
+        self._histograms: Dict[Tuple, Histogram] = {}
+        self._gauges: Dict[str, Tuple[Callable, Optional[str]]] = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def inc(self, name: str, n: float = 1, **labels) -> None:
+        if not self.enabled:
+            return None
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+        return None
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return None
+        key = (name, _labels(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(self.buckets)
+            hist.observe(value)
+        return None
+
+    def gauge(self, name: str, fn: Callable, help: str = '', label: Optional[str] = None) -> None:
+        self._gauges[name] = (fn, label)
+        self.help[name] = help
+
+    @contextmanager
+    def _timer(self, name, labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.inc(name.replace('_seconds', '_errors_total'), error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def timer(self, name: str, **labels):
+        """
+        Context manager that observes the time spent in the block,
+        exceptions are counted in the matching _errors_total counter
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name, labels)
+
+    def wrap(self, fn: Callable, name: str, **labels) -> Callable:
+        """
+        Time every call of fn, fn is returned as is if metrics are disabled
+        """
+        if not self.enabled:
+            return fn
+
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            with self._timer(name, labels):
+                return fn(*args, **kwargs)
+        return timed
+
+    def instrument(self, bm, ops: Iterable[str] = BOOKMARKET_OPS, gauges: bool = True) -> None:
+        """
+        Time the ops methods of a Bookmarket instance and register its gauges
+        (records, size on disk, the query cache and fetch cache counters).
+        The methods are only wrapped on the instance and only if metrics are enabled.
+        With many databases open (one per chat) pass gauges=False, the gauges
+        are registered by name and would only describe the last one: register
+        dict gauges keyed by database instead (see setup_metrics in the bot).
+        """
+        if not self.enabled:
+            return None
+        self.help['bookmarket_op_seconds'] = 'Latency of the Bookmarket operations'
+        for op in ops:
+            setattr(bm, op, self.wrap(getattr(bm, op), 'bookmarket_op_seconds', op=op))
+        if not gauges:
+            return None
+        self.gauge('bookmarket_records', lambda: len(bm), 'Records in the database')
+        self.gauge('bookmarket_db_bytes', bm.size_on_disk, 'Size of the database files')
+        self.gauge('bookmarket_query_cache', lambda: dict(bm.queries.counts),
+                   'Query cache lookups by outcome', label='outcome')
+        self.gauge('bookmarket_query_cache_hit_ratio', lambda: bm.queries.stats()['hit_rate'],
+                   'Share of search / smatch / stime answered by the query cache')
+        if bm.cache is not None:
+            self.instrument_cache(bm.cache)
+        return None
+
+    def instrument_cache(self, cache) -> None:
+        """
+        Register the gauges of a FetchCache (entries and lookups by outcome)
+        """
+        self.gauge('bookmarket_fetch_cache_entries', lambda: len(cache), 'Entries of the fetch cache')
+        self.gauge('bookmarket_fetch_cache', lambda: dict(cache.counts),
+                   'Fetch cache lookups by outcome', label='outcome')
+        self.gauge('bookmarket_fetch_cache_hit_ratio', lambda: cache.stats()['hit_rate'],
+                   'Share of fetches answered by the cache (fresh or revalidated)')
+        return None
+
+    def _read_gauges(self):
+        for name, (fn, label) in list(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                logger.exception(f'Could not read gauge {name}')
+                continue
+            if isinstance(value, dict):
+                yield name, [(((label, k),), v) for k, v in value.items()]
+            else:
+                yield name, [((), value)]
+
+    def render(self) -> str:
+        """
+        All the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def header(name, kind):
+            if self.help.get(name):
+                lines.append(f'# HELP {name} {self.help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count))
+                                for key, h in self._histograms.items())
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                header(name, 'counter')
+                last = name
+            lines.append(f'{name}{_fmt_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            if name != last:
+                header(name, 'histogram')
+                last = name
+            seen = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                seen += n
+                lines.append(f'{name}_bucket{_fmt_labels(labels + (("le", bound),))} {seen}')
+            lines.append(f'{name}_sum{_fmt_labels(labels)} {total}')
+            lines.append(f'{name}_count{_fmt_labels(labels)} {count}')
+        for name, samples in self._read_gauges():
+            header(name, 'gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{_fmt_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """
+        Short human readable version of the metrics (for the bot /metrics command)
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for (name, labels), h in histograms:
+            lines.append(f'{name}{_fmt_labels(labels)}: {h.count} calls, mean {h.sum / h.count * 1e3:.1f} ms, '
+                         f'p50 < {h.quantile(0.5) * 1e3:g} ms, p95 < {h.quantile(0.95) * 1e3:g} ms')
+        for (name, labels), value in counters:
+            lines.append(f'{name}{_fmt_labels(labels)}: {value:g}')
+        for name, samples in self._read_gauges():
+            for labels, value in samples:
+                lines.append(f'{name}{_fmt_labels(labels)}: {value:.4g}')
+        return '\n'.join(lines)
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """
+        Serve render() at http://host:port/metrics from a daemon thread
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return None
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return None
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def shutdown(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+METRICS = Metrics()  # Global registry used by the fetch path and the bot
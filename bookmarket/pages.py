@@ -0,0 +1,73 @@
+"""
+Paged delivery of query results: records are packed in html messages
+up to the Telegram length limit and pulled from the database only when
+the page that shows them is requested.
+"""
+from html import escape
+from typing import Callable, Iterable, List, Optional
+MESSAGE_LIMIT = 4096  # max length of a Telegram message
+FETCH_SIZE = 10  # records pulled from the database at a time
+
+
+def format_record(r, show_desc=True) -> str:
+    title = r.title
+    if title is not None and len(title) > 80:
+        title = title[:80] + '...'
+
+    msg = f'<b>{escape(str(title))}</b>\n{escape(r.url)}\n{r.human_ts}\n'
+    if r.info is not None and show_desc:
+        info = r.info[:125].replace('\n', ' ')
+        msg += f'<pre>{escape(info + "...")}</pre>'
+    return msg
+
+
+class ResultCursor:
+    """
+    Pages of a query result.
+    fetch(offset, limit) returns the records of the query from offset on,
+    pages are built on demand and cached, so going back costs nothing.
+    """
+    def __init__(self, fetch: Callable[[int, int], Iterable], fmt: Callable = format_record,
+                 limit: int = MESSAGE_LIMIT):
+        self.fetch = fetch
+        self.fmt = fmt
+        self.limit = limit
+        self.pages: List[str] = []
+        self.offset = 0  # records already placed in a page
+        self.done = False
+        self._buffer: List[str] = []  # formatted records not placed yet
+
+    def _fill(self) -> None:
+        if not self._buffer and not self.done:
+            self._buffer = [self.fmt(r) for r in self.fetch(self.offset, FETCH_SIZE)]
+            self.done = not self._buffer
+
+    def _build_page(self) -> None:
+        page, size = [], 0
+        while True:
+            self._fill()
+            if not self._buffer:
+                break
+            chunk = self._buffer[0][:self.limit]
+            if page and size + len(chunk) + 1 > self.limit:
+                break
+            page.append(chunk)
+            size += len(chunk) + 1
+            self._buffer.pop(0)
+            self.offset += 1
+        if page:
+            self.pages.append('\n'.join(page))
+
+    def page(self, i: int) -> Optional[str]:
+        """
+        Text of the i-th page, None if the result has less pages
+        """
+        while len(self.pages) <= i and not self.done:
+            self._build_page()
+        return self.pages[i] if 0 <= i < len(self.pages) else None
+
+    def has_next(self, i: int) -> bool:
+        if i + 1 < len(self.pages):
+            return True
+        self._fill()
+        return bool(self._buffer)
@@ -0,0 +1,145 @@
+"""
+LRU pool of open handles, used by the bot to keep open only the Bookmarket
+of the chats that are active: handles idle for `idle_timeout` seconds or
+past `max_open` are closed (least recently used first) and opened again
+on the next request. Handles in use are never closed.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Generic, Hashable, List, Optional, TypeVar
+import threading
+import time
+T = TypeVar('T')
+
+
+class _Entry:
+    def __init__(self):
+        self.handle = None
+        self.error: Optional[BaseException] = None
+        self.ready = threading.Event()  # set once opened (or failed)
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class HandlePool(Generic[T]):
+    """
+    opener(key) returns the handle of key, closer(handle) releases it.
+    Opening and closing happen outside the pool lock, so a slow database
+    load only holds up the users of that key.
+    """
+    def __init__(self, opener: Callable[[Hashable], T], closer: Callable[[T], None],
+                 max_open: int = 32, idle_timeout: float = 60 * 10):
+        self.opener = opener
+        self.closer = closer
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._entries: Dict[Hashable, _Entry] = OrderedDict()  # least recently used first
+        self._closing: Dict[Hashable, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def handles(self) -> List[T]:
+        """
+        The handles open right now (for stats, don't keep them around)
+        """
+        with self._lock:
+            return [e.handle for e in self._entries.values() if e.ready.is_set() and e.error is None]
+
+    @contextmanager
+    def open(self, key: Hashable):
+        """
+        Use the handle of key in a with block, opening it if needed
+        """
+        entry = self._acquire(key)
+        try:
+            yield entry.handle
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+            self.sweep()
+
+    def _acquire(self, key) -> _Entry:
+        while True:
+            with self._lock:
+                closing = self._closing.get(key)
+                if closing is None:
+                    entry = self._entries.get(key)
+                    create = entry is None
+                    if create:
+                        entry = self._entries[key] = _Entry()
+                    entry.users += 1
+                    self._entries.move_to_end(key)
+                    break
+            closing.wait()  # The old handle must be closed before opening it again
+
+        if create:
+            try:
+                entry.handle = self.opener(key)
+            except BaseException as e:
+                entry.error = e
+                with self._lock:
+                    del self._entries[key]
+                raise
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+        return entry
+
+    def sweep(self) -> int:
+        """
+        Close the handles idle for too long and the least recently used
+        ones past max_open. Returns how many were closed.
+        """
+        now = time.monotonic()
+        evicted: List = []
+        with self._lock:
+            extra = len(self._entries) - self.max_open
+            for key, entry in list(self._entries.items()):
+                if entry.users or not entry.ready.is_set():
+                    continue
+                if extra > 0 or now - entry.last_used >= self.idle_timeout:
+                    del self._entries[key]
+                    self._closing[key] = threading.Event()
+                    evicted.append((key, entry))
+                    extra -= 1
+        for key, entry in evicted:
+            self._close(key, entry)
+        return len(evicted)
+
+    def _close(self, key, entry) -> None:
+        try:
+            self.closer(entry.handle)
+        finally:
+            with self._lock:
+                self._closing.pop(key).set()
+
+    def close_all(self) -> None:
+        """
+        Close every handle, waiting for the ones in use to be released
+        """
+        while True:
+            with self._lock:
+                if not self._entries:
+                    return
+                key, entry = next(iter(self._entries.items()))
+            while True:
+                with self._lock:
+                    if entry.users == 0 and entry.ready.is_set():
+                        if self._entries.get(key) is entry:
+                            del self._entries[key]
+                            self._closing[key] = threading.Event()
+                            break
+                        entry = None
+                        break
+                time.sleep(0.05)
+            if entry is not None:
+                self._close(key, entry)
@@ -0,0 +1,182 @@
+"""
+BM25 ranked keyword search over title / url / info.
+The term frequencies are kept in NumPy arrays (one CSR row of postings per
+token) so a query is scored with a few vectorized operations and the best
+k are picked with argpartition, without sorting every match.
+Records changed after the build are kept aside and scored in python until
+there are enough of them to rebuild the arrays.
+"""
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+import threading
+import bisect
+import math
+import numpy as np
+try:
+    from .storage import TOKEN_RE
+except ImportError:  # running the bot as a script from the bookmarket folder
+    from storage import TOKEN_RE
+
+RANK_FIELDS = ('title', 'url', 'info')
+WEIGHTS = (3.0, 1.0, 1.0)  # title matches count three times as much
+MAX_EXPANSIONS = 32  # tokens a keyword prefix can expand to
+
+
+def term_counts(doc: dict) -> Tuple[Counter, ...]:
+    """
+    Token counts of each ranked field of a document
+    """
+    return tuple(Counter(TOKEN_RE.findall(str(doc[f]).lower())) if doc.get(f) is not None else Counter()
+                 for f in RANK_FIELDS)
+
+
+class BM25Index:
+    """
+    BM25F index of a snapshot of the documents, built by build(docs).
+    add / remove keep it up to date, needs_rebuild tells when the
+    documents changed since the build are too many to be scored in python.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75, weights: Tuple[float, ...] = WEIGHTS,
+                 rebuild_ratio: float = 0.02):
+        self.k1 = k1
+        self.b = b
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.rebuild_ratio = rebuild_ratio
+        self._lock = threading.Lock()
+        self.build([])
+
+    def build(self, docs: Iterable[dict]) -> None:
+        urls, lens = [], []
+        vocab: Dict[str, int] = {}
+        terms, positions, fields, counts = [], [], [], []
+        for pos, doc in enumerate(docs):
+            urls.append(doc['url'])
+            doc_lens = []
+            for f, tf in enumerate(term_counts(doc)):
+                doc_lens.append(sum(tf.values()))
+                for token, n in tf.items():
+                    terms.append(vocab.setdefault(token, len(vocab)))
+                    positions.append(pos)
+                    fields.append(f)
+                    counts.append(n)
+            lens.append(doc_lens)
+
+        n_docs = len(urls)
+        terms = np.asarray(terms, dtype=np.int64)
+        # One posting per (term, document) pair, sorted by term then position
+        keys, inverse = np.unique(terms * max(n_docs, 1) + np.asarray(positions, dtype=np.int64),
+                                  return_inverse=True)
+        tf = np.zeros((len(keys), len(RANK_FIELDS)), dtype=np.float32)
+        np.add.at(tf, (inverse.ravel(), np.asarray(fields, dtype=np.intp)),
+                  np.asarray(counts, dtype=np.float32))
+        lens = np.asarray(lens, dtype=np.float32).reshape(n_docs, len(RANK_FIELDS))
+        avg = lens.mean(axis=0) if n_docs else np.ones(len(RANK_FIELDS), dtype=np.float32)
+        avg[avg == 0] = 1
+
+        with self._lock:
+            self._urls = urls
+            self._pos = {url: pos for pos, url in enumerate(urls)}
+            self._vocab = vocab
+            self._sorted_vocab = sorted(vocab)
+            self._indptr = np.searchsorted(keys // max(n_docs, 1), np.arange(len(vocab) + 1))
+            self._indices = (keys % max(n_docs, 1)).astype(np.int32)
+            self._df = np.diff(self._indptr)
+            # Per field length normalisation of BM25F, computed once for every posting
+            norm = 1 - self.b + self.b * lens[self._indices] / avg
+            self._wtf = (tf * self.weights / norm).sum(axis=1)
+            self._avg = avg
+            self._alive = np.ones(n_docs, dtype=bool)
+            self._n_dead = 0
+            self._delta: Dict[str, Tuple[Counter, ...]] = {}  # url -> term counts of a changed document
+
+    def __len__(self):
+        return len(self._urls) - self._n_dead + len(self._delta)
+
+    @property
+    def needs_rebuild(self) -> bool:
+        return len(self._delta) + self._n_dead > max(256, self.rebuild_ratio * len(self._urls))
+
+    def remove(self, url: str) -> None:
+        with self._lock:
+            self._delta.pop(url, None)
+            pos = self._pos.get(url)
+            if pos is not None and self._alive[pos]:
+                self._alive[pos] = False
+                self._n_dead += 1
+
+    def add(self, doc: dict) -> None:
+        """
+        Add a new or updated document
+        """
+        self.remove(doc['url'])
+        with self._lock:
+            self._delta[doc['url']] = term_counts(doc)
+
+    def _expand(self, keyword: str) -> List[str]:
+        """
+        Tokens matched by a keyword, the ones it is a prefix of (itself first if indexed)
+        """
+        i = bisect.bisect_left(self._sorted_vocab, keyword)
+        tokens = []
+        while (i < len(self._sorted_vocab) and self._sorted_vocab[i].startswith(keyword)
+               and len(tokens) < MAX_EXPANSIONS):
+            tokens.append(self._sorted_vocab[i])
+            i += 1
+        return tokens
+
+    def top(self, keywords: Iterable[str], k: int = 10) -> List[Tuple[str, float]]:
+        """
+        The k (url, score) pairs with the best BM25 score, best first.
+        A document matches if it has any of the keywords (or a token they are a prefix of)
+        """
+        keywords = {t for kw in keywords for t in TOKEN_RE.findall(kw.lower())}
+        with self._lock:
+            n = len(self)
+            scores = np.zeros(len(self._urls), dtype=np.float32)
+            delta_scores = Counter()
+            for kw in keywords:
+                for token in self._tokens(kw):
+                    t = self._vocab.get(token)
+                    lo, hi = (0, 0) if t is None else (self._indptr[t], self._indptr[t + 1])
+                    ids = self._indices[lo:hi]
+                    delta = {}
+                    for url, tfs in self._delta.items():
+                        wtf = self._delta_wtf(tfs, token)
+                        if wtf:
+                            delta[url] = wtf
+                    # Documents removed since the build do not count
+                    df = (np.count_nonzero(self._alive[ids]) if self._n_dead else hi - lo) + len(delta)
+                    idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                    wtf = self._wtf[lo:hi]
+                    scores[ids] += idf * wtf * (self.k1 + 1) / (self.k1 + wtf)
+                    for url, wtf in delta.items():
+                        delta_scores[url] += idf * wtf * (self.k1 + 1) / (self.k1 + wtf)
+            scores[~self._alive] = 0
+
+            matches = np.flatnonzero(scores)
+            if len(matches) > k:
+                matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+            best = [(self._urls[i], float(scores[i])) for i in matches]
+        best += list(delta_scores.items())
+        best.sort(key=lambda pair: -pair[1])
+        return best[:k]
+
+    def _tokens(self, keyword: str) -> set:
+        """
+        Tokens a keyword matches in the arrays and in the documents changed after the build
+        """
+        tokens = set(self._expand(keyword))
+        for tfs in self._delta.values():
+            tokens.update(t for tf in tfs for t in tf if t.startswith(keyword))
+        return tokens
+
+    def _delta_wtf(self, tfs: Tuple[Counter, ...], token: str) -> float:
+        """
+        Weighted and length normalised term frequency of a changed document, as in build
+        """
+        wtf = 0.0
+        for f, tf in enumerate(tfs):
+            if token in tf:
+                norm = 1 - self.b + self.b * sum(tf.values()) / float(self._avg[f])
+                wtf += float(self.weights[f]) * tf[token] / norm
+        return wtf
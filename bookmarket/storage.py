@@ -0,0 +1,695 @@
+"""
+Storage backends used by Bookmarket.
+A storage keeps the bookmark documents (dicts with url, title, info, ts
+and the fetch metadata fetched, status, failures)
+and whatever index it needs to look them up by url, keyword and time.
+Mutations always happen between begin() and commit() / rollback().
+"""
+from tinydb import TinyDB
+from tinyrecord import transaction
+from tinyrecord.operations import Operation
+from collections import defaultdict
+from typing import Optional, List, Iterable, Iterator, Tuple
+import threading
+import sqlite3
+import json
+import bisect
+import sys
+import os
+import re
+TOKEN_RE = re.compile(r'\w+')
+FIELDS = ('url', 'title', 'info', 'ts', 'fetched', 'status', 'failures')
+ORDERS = ('id', 'ts', '-ts')
+
+
+def tokenize(text):
+    """
+    Split a field into the lowercase alphanumeric tokens used by the search index
+    """
+    if text is None:
+        return set()
+    return set(TOKEN_RE.findall(str(text).lower()))
+
+
+class Storage:
+    """
+    Interface of a storage backend, documents are plain dicts.
+    """
+    flushes = 0  # number of commits that reached the disk
+
+    def begin(self) -> None:
+        raise NotImplementedError
+
+    def commit(self) -> None:
+        raise NotImplementedError
+
+    def rollback(self) -> None:
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, url) -> bool:
+        return self.get_url(url) is not None
+
+    def get_url(self, url: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def iter_all(self, order: str = 'id') -> Iterator[dict]:
+        """
+        Lazily yield every document, order is one of ORDERS
+        (insertion, oldest first or newest first)
+        """
+        raise NotImplementedError
+
+    def all(self) -> List[dict]:
+        return list(self.iter_all())
+
+    def search(self, q) -> List[dict]:
+        """
+        Documents matching a TinyDB query (or any callable taking a dict)
+        """
+        return [doc for doc in self.iter_all() if q(doc)]
+
+    def get(self, q) -> Optional[dict]:
+        return next((doc for doc in self.iter_all() if q(doc)), None)
+
+    def match(self, fields: dict) -> List[dict]:
+        """
+        Documents whose fields are equal to the ones passed
+        """
+        raise NotImplementedError
+
+    def iter_text(self, tokens: Iterable[str], order: str = 'id') -> Iterator[dict]:
+        """
+        Documents having, for each token, a title / url / info token starting with it
+        """
+        raise NotImplementedError
+
+    def search_text(self, tokens: Iterable[str]) -> List[dict]:
+        return list(self.iter_text(tokens))
+
+    def iter_time_range(self, start: float, end: float, reverse: bool = False) -> Iterator[dict]:
+        """
+        Documents with start <= ts < end, sorted by ts
+        """
+        raise NotImplementedError
+
+    def time_range(self, start: float, end: float) -> List[dict]:
+        return list(self.iter_time_range(start, end))
+
+    def count_time(self, start: float, end: float) -> int:
+        return len(self.time_range(start, end))
+
+    def insert(self, doc: dict) -> int:
+        """
+        Insert a document and return its id, the url must not exist
+        """
+        raise NotImplementedError
+
+    def update(self, url: str, fields: dict) -> bool:
+        """
+        Update the fields of the document with url, False if it does not exist
+        """
+        raise NotImplementedError
+
+    def delete(self, url: str) -> bool:
+        """
+        Delete the document with url, False if it does not exist
+        """
+        raise NotImplementedError
+
+    def truncate(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class IndexedStorage(Storage):
+    """
+    Base for the storages that keep every document in memory with
+    a url index, a sorted ts index and an inverted token index.
+    Subclasses load the documents and persist the changes.
+    """
+    def __init__(self):
+        self._docs = {}  # doc_id -> document
+        self._urls = {}  # url -> doc_id
+        self._ts = []  # sorted (ts, doc_id) pairs, used for time ranges
+        self._postings = defaultdict(set)  # token -> doc_ids
+        self._vocab = []  # sorted tokens, used for prefix lookups
+        self._last_id = 0
+        self._reload()
+
+    def _load(self) -> Iterable[Tuple[int, dict]]:
+        """
+        (doc_id, document) pairs currently persisted
+        """
+        raise NotImplementedError
+
+    def _persist_insert(self, doc_id: int, doc: dict) -> None:
+        raise NotImplementedError
+
+    def _persist_update(self, doc_id: int, fields: dict) -> None:
+        raise NotImplementedError
+
+    def _persist_delete(self, doc_id: int) -> None:
+        raise NotImplementedError
+
+    def _reload(self) -> None:
+        self._docs.clear()
+        self._urls.clear()
+        self._postings.clear()
+        for doc_id, doc in self._load():
+            self._docs[doc_id] = doc
+            self._add_keys(doc_id, doc, sort=False)
+        self._ts = sorted((d['ts'], i) for i, d in self._docs.items() if d.get('ts') is not None)
+        self._vocab = sorted(self._postings)
+        self._last_id = max(self._docs, default=0)
+
+    def _add_keys(self, doc_id, doc, sort=True):
+        self._urls[doc['url']] = doc_id
+        if sort and doc.get('ts') is not None:
+            bisect.insort(self._ts, (doc['ts'], doc_id))
+        for field in ('title', 'url', 'info'):
+            for token in tokenize(doc.get(field)):
+                if sort and token not in self._postings:
+                    bisect.insort(self._vocab, token)
+                self._postings[token].add(doc_id)
+
+    def _remove_keys(self, doc_id, doc):
+        if self._urls.get(doc['url']) == doc_id:
+            del self._urls[doc['url']]
+        if doc.get('ts') is not None:
+            del self._ts[bisect.bisect_left(self._ts, (doc['ts'], doc_id))]
+        for field in ('title', 'url', 'info'):
+            for token in tokenize(doc.get(field)):
+                ids = self._postings.get(token)
+                if ids is None:
+                    continue
+                ids.discard(doc_id)
+                if not ids:
+                    del self._postings[token]
+                    del self._vocab[bisect.bisect_left(self._vocab, token)]
+
+    def _match_prefix(self, prefix):
+        """
+        Union of the posting lists of every token starting with prefix
+        """
+        ids = set()
+        i = bisect.bisect_left(self._vocab, prefix)
+        while i < len(self._vocab) and self._vocab[i].startswith(prefix):
+            ids |= self._postings[self._vocab[i]]
+            i += 1
+        return ids
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, url) -> bool:
+        return url in self._urls
+
+    def get_url(self, url: str) -> Optional[dict]:
+        doc_id = self._urls.get(url)
+        return None if doc_id is None else self._docs[doc_id]
+
+    def iter_all(self, order='id'):
+        # Walk the indexes rather than the dicts, changes made while
+        # iterating are tolerated (and may or may not be seen)
+        if order == 'id':
+            for i in range(1, self._last_id + 1):
+                doc = self._docs.get(i)
+                if doc is not None:
+                    yield doc
+        else:
+            yield from self.iter_time_range(float('-inf'), float('inf'), reverse=order == '-ts')
+
+    def match(self, fields: dict) -> List[dict]:
+        if 'url' in fields:
+            doc = self.get_url(fields['url'])
+            docs = [] if doc is None else [doc]
+        else:
+            docs = self._docs.values()
+        return [d for d in docs if all(d.get(k) == v for k, v in fields.items())]
+
+    def iter_text(self, tokens, order='id'):
+        postings = sorted((self._match_prefix(t) for t in tokens), key=len)
+        ids = postings[0]
+        for p in postings[1:]:
+            if not ids:
+                break
+            ids = ids & p
+        if order == 'id':
+            ids = sorted(ids)
+        else:
+            ids = sorted(ids, key=lambda i: (self._docs[i]['ts'], i), reverse=order == '-ts')
+        for i in ids:
+            doc = self._docs.get(i)
+            if doc is not None:
+                yield doc
+
+    def _time_slice(self, start: float, end: float) -> slice:
+        lo = bisect.bisect_left(self._ts, (start,))
+        hi = bisect.bisect_left(self._ts, (end,))
+        return slice(lo, max(lo, hi))
+
+    def iter_time_range(self, start, end, reverse=False):
+        sl = self._time_slice(start, end)
+        positions = range(sl.start, sl.stop)
+        for k in reversed(positions) if reverse else positions:
+            if k >= len(self._ts):
+                continue
+            doc = self._docs.get(self._ts[k][1])
+            if doc is not None:
+                yield doc
+
+    def count_time(self, start: float, end: float) -> int:
+        sl = self._time_slice(start, end)
+        return sl.stop - sl.start
+
+    def insert(self, doc: dict) -> int:
+        self._last_id += 1
+        doc = dict(doc)
+        self._persist_insert(self._last_id, doc)
+        self._docs[self._last_id] = doc
+        self._add_keys(self._last_id, doc)
+        return self._last_id
+
+    def update(self, url: str, fields: dict) -> bool:
+        doc_id = self._urls.get(url)
+        if doc_id is None:
+            return False
+        self._persist_update(doc_id, fields)
+        doc = self._docs[doc_id]
+        self._remove_keys(doc_id, doc)
+        doc = self._docs[doc_id] = {**doc, **fields}
+        self._add_keys(doc_id, doc)
+        return True
+
+    def delete(self, url: str) -> bool:
+        doc_id = self._urls.get(url)
+        if doc_id is None:
+            return False
+        self._persist_delete(doc_id)
+        self._remove_keys(doc_id, self._docs.pop(doc_id))
+        return True
+
+
+class _Insert(Operation):
+    """
+    Insert a document at a doc id chosen by the storage, this way the
+    in-memory indexes can be updated before the transaction is committed.
+    """
+    def __init__(self, doc_id, doc):
+        self.doc_id = doc_id
+        self.doc = dict(doc)
+
+    def perform(self, data):
+        data[self.doc_id] = self.doc
+
+
+class TinyStorage(IndexedStorage):
+    """
+    TinyDB json file, every change of a batch is committed with a single
+    tinyrecord transaction, i.e. a single rewrite of the file.
+    """
+    def __init__(self, path):
+        self.db = TinyDB(path)
+        self._tr = None  # transaction of the open batch
+        super().__init__()
+
+    def _load(self):
+        return ((doc.doc_id, dict(doc)) for doc in self.db.all())
+
+    def _persist_insert(self, doc_id, doc):
+        self._tr.record.append(_Insert(doc_id, doc))
+
+    def _persist_update(self, doc_id, fields):
+        self._tr.update(fields, doc_ids=[doc_id])
+
+    def _persist_delete(self, doc_id):
+        self._tr.remove(doc_ids=[doc_id])
+
+    def begin(self):
+        self._tr = transaction(self.db)
+
+    def commit(self):
+        tr, self._tr = self._tr, None
+        if tr.record.record:  # Nothing changed, skip the write
+            with tr.lock:
+                tr.record.execute()
+            self.flushes += 1
+
+    def rollback(self):
+        self._tr = None
+        self._reload()  # Drop the uncommitted changes
+
+    def truncate(self):
+        self.db.truncate()
+        self._reload()
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteStorage(Storage):
+    """
+    SQLite database in WAL mode, with indexes on url and ts
+    and an FTS5 table over title / url / info for keyword searches.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS records (
+        id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, title TEXT, info TEXT, ts REAL,
+        fetched REAL, status INTEGER, failures INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS records_ts ON records (ts);
+    CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5(
+        title, url, info, content='records', content_rowid='id', tokenize="unicode61 tokenchars '_'"
+    );
+    CREATE TRIGGER IF NOT EXISTS records_ai AFTER INSERT ON records BEGIN
+        INSERT INTO records_fts (rowid, title, url, info) VALUES (new.id, new.title, new.url, new.info);
+    END;
+    CREATE TRIGGER IF NOT EXISTS records_ad AFTER DELETE ON records BEGIN
+        INSERT INTO records_fts (records_fts, rowid, title, url, info)
+        VALUES ('delete', old.id, old.title, old.url, old.info);
+    END;
+    CREATE TRIGGER IF NOT EXISTS records_au AFTER UPDATE ON records BEGIN
+        INSERT INTO records_fts (records_fts, rowid, title, url, info)
+        VALUES ('delete', old.id, old.title, old.url, old.info);
+        INSERT INTO records_fts (rowid, title, url, info) VALUES (new.id, new.title, new.url, new.info);
+    END;
+    """
+    COLUMNS = ', '.join(FIELDS)
+    PLACEHOLDERS = ', '.join('?' * len(FIELDS))
+    ORDER_BY = {'id': 'id', 'ts': 'ts, id', '-ts': 'ts DESC, id DESC'}
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.con.row_factory = sqlite3.Row
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._dirty = False
+
+    def _query(self, sql, params=()) -> List[dict]:
+        with self._lock:
+            return [dict(row) for row in self.con.execute(sql, params)]
+
+    def _iter_query(self, sql, params=(), size=256) -> Iterator[dict]:
+        """
+        Like _query but rows are fetched lazily, `size` at a time
+        """
+        with self._lock:
+            cur = self.con.execute(sql, params)
+        try:
+            while True:
+                with self._lock:
+                    rows = cur.fetchmany(size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(row)
+        finally:
+            cur.close()
+
+    def _execute(self, sql, params=()) -> int:
+        with self._lock:
+            return self.con.execute(sql, params).rowcount
+
+    def begin(self):
+        self._execute('BEGIN IMMEDIATE')
+        self._dirty = False
+
+    def commit(self):
+        self._execute('COMMIT')
+        if self._dirty:
+            self.flushes += 1
+
+    def rollback(self):
+        self._execute('ROLLBACK')
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) AS n FROM records')[0]['n']
+
+    def get_url(self, url):
+        rows = self._query(f'SELECT {self.COLUMNS} FROM records WHERE url = ?', (url,))
+        return rows[0] if rows else None
+
+    def iter_all(self, order='id'):
+        return self._iter_query(f'SELECT {self.COLUMNS} FROM records ORDER BY {self.ORDER_BY[order]}')
+
+    def match(self, fields):
+        if not fields:
+            return self.all()
+        where = ' AND '.join(f'{k} = ?' for k in fields if k in FIELDS)
+        if len(fields) != where.count('?'):  # A field that is not a column can't match
+            return []
+        return self._query(f'SELECT {self.COLUMNS} FROM records WHERE {where} ORDER BY id',
+                           tuple(fields.values()))
+
+    def iter_text(self, tokens, order='id'):
+        query = ' AND '.join(f'"{t}"*' for t in tokens)
+        return self._iter_query(f'SELECT {self.COLUMNS} FROM records WHERE id IN '
+                                '(SELECT rowid FROM records_fts WHERE records_fts MATCH ?) '
+                                f'ORDER BY {self.ORDER_BY[order]}', (query,))
+
+    def iter_time_range(self, start, end, reverse=False):
+        return self._iter_query(f'SELECT {self.COLUMNS} FROM records WHERE ts >= ? AND ts < ? '
+                                f'ORDER BY {self.ORDER_BY["-ts" if reverse else "ts"]}', (start, end))
+
+    def count_time(self, start, end):
+        return self._query('SELECT COUNT(*) AS n FROM records WHERE ts >= ? AND ts < ?',
+                           (start, end))[0]['n']
+
+    def insert(self, doc):
+        with self._lock:
+            cur = self.con.execute(f'INSERT INTO records ({self.COLUMNS}) VALUES ({self.PLACEHOLDERS})',
+                                   tuple(doc.get(k) for k in FIELDS))
+            self._dirty = True
+            return cur.lastrowid
+
+    def update(self, url, fields):
+        fields = {k: v for k, v in fields.items() if k in FIELDS}
+        if not fields:
+            return url in self
+        sets = ', '.join(f'{k} = ?' for k in fields)
+        found = self._execute(f'UPDATE records SET {sets} WHERE url = ?', (*fields.values(), url)) > 0
+        self._dirty |= found
+        return found
+
+    def delete(self, url):
+        found = self._execute('DELETE FROM records WHERE url = ?', (url,)) > 0
+        self._dirty |= found
+        return found
+
+    def truncate(self):
+        self._execute('DELETE FROM records')
+
+    def close(self):
+        with self._lock:
+            self.con.close()
+
+
+class LogStorage(IndexedStorage):
+    """
+    Append-only log of json lines, each commit appends a single line with its
+    operations so a write costs O(1) I/O and a torn last line (crash while
+    appending) only loses that commit. At startup the state is rebuilt from the
+    last snapshot plus the log. Once the log is longer than `compact_every`
+    lines a background thread writes a new snapshot and starts a fresh log.
+    """
+    def __init__(self, path, compact_every: int = 1000):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.old_path = path + '.old'  # log being compacted
+        self.compact_every = compact_every
+        self._ops = None  # operations of the open batch
+        self._io_lock = threading.Lock()  # held by open batches and compactions
+        self._compactor = None
+        self._log_lines = 0
+        self._epoch = 0  # bumped by truncate, a compaction started before it is dropped
+        super().__init__()
+        self._log = open(self.path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _replay(path, docs) -> Tuple[int, int]:
+        """
+        Apply the operations logged in path to docs, returns the number of lines
+        and the byte offset where the good lines end (a torn last line starts there).
+        Replaying is idempotent, a stale log can safely be applied twice.
+        """
+        lines = end = 0
+        if not os.path.isfile(path):
+            return lines, end
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):  # Torn write of the last commit
+                    break
+                try:
+                    ops = json.loads(line)
+                except ValueError:
+                    break
+                for op, doc_id, *args in ops:
+                    if op == 'i':
+                        docs[doc_id] = args[0]
+                    elif op == 'u' and doc_id in docs:
+                        docs[doc_id] = {**docs[doc_id], **args[0]}
+                    elif op == 'd':
+                        docs.pop(doc_id, None)
+                lines += 1
+                end += len(line)
+        return lines, end
+
+    def _load(self):
+        docs = {}
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                docs = {int(k): v for k, v in json.load(f).items()}
+        self._replay(self.old_path, docs)
+        self._log_lines, end = self._replay(self.path, docs)
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > end:
+            # Cut the torn line, else the next commit would be appended to it and lost with it
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+        return sorted(docs.items())
+
+    def _persist_insert(self, doc_id, doc):
+        self._ops.append(('i', doc_id, doc))
+
+    def _persist_update(self, doc_id, fields):
+        self._ops.append(('u', doc_id, fields))
+
+    def _persist_delete(self, doc_id):
+        self._ops.append(('d', doc_id))
+
+    def begin(self):
+        self._io_lock.acquire()
+        self._ops = []
+
+    def commit(self):
+        try:
+            if self._ops:
+                self._log.write(json.dumps(self._ops) + '\n')
+                self._log.flush()
+                self._log_lines += 1
+                self.flushes += 1
+        finally:
+            self._ops = None
+            self._io_lock.release()
+        if self._log_lines >= self.compact_every:
+            self.compact(background=True)
+
+    def rollback(self):
+        self._ops = None
+        try:
+            self._reload()  # Drop the uncommitted changes
+        finally:
+            self._io_lock.release()
+
+    def compact(self, background: bool = False) -> None:
+        """
+        Write a snapshot of the current state and start a new log
+        """
+        if background:
+            if self._compactor is None or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target=self.compact, daemon=True)
+                self._compactor.start()
+            return None
+
+        with self._io_lock:  # No batch is open, the state is committed
+            epoch = self._epoch
+            if os.path.isfile(self.old_path):  # A previous compaction did not finish
+                docs = dict(self._docs)
+            else:
+                self._log.close()
+                os.replace(self.path, self.old_path)
+                self._log = open(self.path, 'a', encoding='utf-8')
+                self._log_lines = 0
+                docs = dict(self._docs)
+
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(docs, f)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._io_lock:
+            if self._epoch != epoch:  # Truncated meanwhile, the snapshot is stale
+                os.remove(tmp)
+                return None
+            os.replace(tmp, self.snapshot_path)
+            os.remove(self.old_path)
+        return None
+
+    def truncate(self):
+        with self._io_lock:
+            self._log.close()
+            for path in (self.snapshot_path, self.old_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+            self._log = open(self.path, 'w', encoding='utf-8')
+            self._log_lines = 0
+            self._epoch += 1
+            self._reload()
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+        self._log.close()
+
+
+BACKENDS = {'tinydb': TinyStorage, 'sqlite': SQLiteStorage, 'log': LogStorage}
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+LOG_EXTENSIONS = ('.log', '.jsonl')
+
+
+def open_storage(path, backend: Optional[str] = None) -> Storage:
+    """
+    Open the storage at path, if backend is not passed
+    it is chosen from the extension (sqlite, append-only log or tinydb json)
+    """
+    if backend is None:
+        if path.endswith(SQLITE_EXTENSIONS):
+            backend = 'sqlite'
+        elif path.endswith(LOG_EXTENSIONS):
+            backend = 'log'
+        else:
+            backend = 'tinydb'
+    try:
+        return BACKENDS[backend](path)
+    except KeyError:
+        raise ValueError(f'Unknown storage backend {backend!r}, use one of {list(BACKENDS)}')
+
+
+def migrate(src: Storage, dst: Storage) -> int:
+    """
+    Copy every document of src in dst with a single commit,
+    urls already in dst are skipped. Returns the number of documents copied.
+    """
+    copied = 0
+    dst.begin()
+    try:
+        for doc in src.iter_all():
+            if doc['url'] in dst:
+                continue
+            dst.insert({k: doc.get(k) for k in FIELDS})
+            copied += 1
+        dst.commit()
+    except BaseException:
+        dst.rollback()
+        raise
+    return copied
+
+
+if __name__ == '__main__':
+    # python bookmarket/storage.py data/db.json data/db.sqlite
+    if len(sys.argv) != 3 or not os.path.isfile(sys.argv[1]):
+        print('usage: python bookmarket/storage.py <source db> <destination db>')
+        sys.exit(1)
+    src, dst = open_storage(sys.argv[1]), open_storage(sys.argv[2])
+    print(f'Copied {migrate(src, dst)} bookmarks from {sys.argv[1]} to {sys.argv[2]}')
+    src.close()
+    dst.close()
@@ -1,6 +1,7 @@
 import logging
 import sys
 import os
+import re
 import time
 import socket
 import telegram
@@ -12,16 +13,31 @@ from telegram.ext import (
 )
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardMarkup
 from datetime import datetime, timedelta
-from bookmarket import Bookmarket, Record, find_infos, sanitize_url
+from bookmarket import Bookmarket, Record, FetchCache, Enricher, HostBackoff, fetch, sanitize_url
+from pages import ResultCursor, format_record
+from jobs import Jobs
+from metrics import METRICS
+from formats import FORMATS
+from pool import HandlePool
+from archive import PageArchive
 from dataclasses import replace
-import requests
-from requests.exceptions import InvalidURL, MissingSchema, InvalidSchema
 from tinydb import Query
-user_id = None
+DATA = './data'
+owner = None  # chat_id of the owner, the first one of the key file
+allowed = set()  # chat_ids that can use the bot
 Q = Query()
-bm = Bookmarket('./data/db.json')
-session = requests.Session()
-session.max_redirects = 3
+# Scraped pages and failing hosts are the same for everybody, these are shared by all the chats
+fetch_cache = FetchCache(os.path.join(DATA, 'fetch_cache.json'))
+backoff = HostBackoff(os.path.join(DATA, 'host_backoff.json'))
+# Slow handlers run here, fast ones (search, stats) stay on the dispatcher
+jobs = Jobs(workers=8, limits={'fetch': 4, 'update': 2, 'refresh': 2, 'import': 2, 'export': 2})
+REFRESH_EVERY = 60 * 60 * 6  # seconds between the scheduled refreshes of the stale entries
+REFRESH_BUDGET = 200  # entries fetched at most by each refresh
+SEARCH_RESULTS = 30  # best ranked records a search shows
+MAX_OPEN = 32  # chat databases kept open at most
+IDLE_TIMEOUT = 60 * 10  # seconds after which the database of a silent chat is closed
+# Megabytes of compressed page text archived for each chat, the archive is off if unset
+ARCHIVE_MB = int(os.environ.get('BOOKMARKET_ARCHIVE_MB') or 0)
 
 
 # Enable logging
@@ -32,15 +48,47 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def chat_dir(chat_id: int) -> str:
+    # The owner keeps the single user layout, so an existing ./data/db.json is still used
+    return DATA if chat_id == owner else os.path.join(DATA, 'chats', str(chat_id))
+
+
+class Chat:
+    """
+    Database and enricher of a chat, opened by the pool on the first message
+    and closed once the chat is idle. Every chat has its own files and its own
+    Bookmarket lock, so a long update_all only holds up the chat running it.
+    """
+    def __init__(self, chat_id: int):
+        path = chat_dir(chat_id)
+        os.makedirs(path, exist_ok=True)
+        self.id = chat_id
+        self.path = path
+        archive = None
+        if ARCHIVE_MB:
+            archive = PageArchive(os.path.join(path, 'archive'), max_bytes=ARCHIVE_MB * 1024 * 1024)
+        self.bm = Bookmarket(os.path.join(path, 'db.json'), cache=fetch_cache, archive=archive)
+        METRICS.instrument(self.bm, gauges=False)
+        self.enricher = Enricher(self.bm, os.path.join(path, 'enrich_queue.json'))
+        self.enricher.start()
+
+    def close(self) -> None:
+        self.enricher.stop()  # The queue is saved and resumed on the next open
+        self.bm.close()
+
+
+pool = HandlePool(Chat, Chat.close, max_open=MAX_OPEN, idle_timeout=IDLE_TIMEOUT)
+
+
 def start(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id != user_id:
+    if update.message.chat_id not in allowed:
         return
 
     update.message.reply_text('Hi! I am the bookmarket bot')
 
 
 def handle_msg(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id != user_id:
+    if update.message.chat_id not in allowed:
         return
 
     msg = update['message']['text']
@@ -57,17 +105,16 @@ def handle_msg(update: Update, context: CallbackContext) -> None:
         search(update, context)
         return None
 
-    add_or_delete(update, context)
-    return None
+    if cmd in ['fs', 'ft', 'fulltext']:
+        search_pages(update, context)
+        return None
 
+    jobs.submit('fetch', msg.split()[0], add_or_delete, update, context, owner=update.message.chat_id)
+    return None
 
-def any_in(field, *patterns):
-    if field is None:
-        return False
-    return all(p.lower() in field.lower() for p in patterns)
 
 def search_time(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id != user_id:
+    if update.message.chat_id not in allowed:
         return
 
     msg = ' '.join(update['message']['text'].split()[1:])
@@ -77,54 +124,52 @@ def search_time(update: Update, context: CallbackContext) -> None:
         update.message.reply_text('Could not parse the time!')
         return None
 
-    rs = bm.stime(rg.start.to_unixtime(), rg.end.to_unixtime())
-    if rs:
-        msg_records(update, rs)
-    else:
-        update.message.reply_text('Did not find a single thing!')
+    start, end = rg.start.to_unixtime(), rg.end.to_unixtime()
+    msg_records(update, lambda bm, offset, limit: bm.iter_stime(start, end, limit=limit,
+                                                                offset=offset, reverse=True))
     return None
 
 
 def search(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id != user_id:
+    if update.message.chat_id not in allowed:
         return
 
     msg = set(update['message']['text'].split()[1:])
     msg = [m for m in msg if m != ' ']
 
-    rs = set(bm.search(Q.title.test(any_in, *msg)))
-    rs.update(bm.search(Q.url.test(any_in, *msg)))
-    rs.update(bm.search(Q.info.test(any_in, *msg)))
+    def best(bm, offset, limit):  # The ranked result is cached, paging does not score again
+        return bm.search_ranked(*msg, k=SEARCH_RESULTS)[offset:offset + limit]
 
-    if rs:
-        msg_records(update, rs)
-    else:
-        update.message.reply_text('Did not find a single thing!')
+    msg_records(update, best)
     return None
 
 
-def search(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id != user_id:
+def search_pages(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in allowed:
         return
 
-    msg = set(update['message']['text'].split()[1:])
-    msg = [m for m in msg if m != ' ']
+    if not ARCHIVE_MB:
+        update.message.reply_text('The page archive is off, start the bot with BOOKMARKET_ARCHIVE_MB=<size>')
+        return None
+    msg = update['message']['text'].split()[1:]
 
-    rs = set(bm.search(Q.title.test(any_in, *msg)))
-    rs.update(bm.search(Q.url.test(any_in, *msg)))
-    rs.update(bm.search(Q.info.test(any_in, *msg)))
+    def best(bm, offset, limit):
+        return bm.search_pages(*msg, k=SEARCH_RESULTS)[offset:offset + limit]
 
-    if rs:
-        msg_records(update, rs)
-    else:
-        update.message.reply_text('Did not find a single thing!')
+    msg_records(update, best)
     return None
 
 
 def add_or_delete(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id != user_id:
+    if update.message.chat_id not in allowed:
         return
 
+    with pool.open(update.message.chat_id) as chat:
+        _add_or_delete(update, chat.bm)
+    return None
+
+
+def _add_or_delete(update: Update, bm: Bookmarket) -> None:
     msg = update['message']['text'].split()
     url = msg.pop(0)
     url = sanitize_url(url)
@@ -134,27 +179,26 @@ def add_or_delete(update: Update, context: CallbackContext) -> None:
     action_name = 'Delete'
     premsg = 'This url already exists, do you want to delete it? 🤔\n'
     action = 'delete'
-    r = bm.get(Q.url == url)
+    r = bm.get_canonical(url)  # Also finds the same page saved with another url
+    if r is None:  # A single request checks the link and scrapes it
+        res = fetch(url, bm.cache)
+        if not res.ok:
+            update.message.reply_text('Could not open the link you passed')
+            return None
+        url = sanitize_url(res.url)  # Store the redirect target
+        r = bm.get_canonical(url)
+
     if r is None:
         action_name = 'Add'
         action = 'add'
         premsg = 'This url does not exist, want to add it? 🤔\n'
-        try:  # I mean this is slow, 2 full reqs for no reason TODO
-            req = session.get(url, headers={'User-Agent': 'Magic Browser'})
-        except (InvalidURL, MissingSchema, InvalidSchema, requests.Timeout,
-                requests.HTTPError, requests.ConnectionError):
-            update.message.reply_text('Could not open the link you passed')
-            return None, None
 
         if msg:
             title = msg.pop(0)
             info = ' '.join(msg)
 
-        if title is None or info is None:
-            stitle, sinfo = find_infos(url)
-            title = stitle if title is None else title
-            info = sinfo if info is None else info
-
+        title = res.title if title is None else title
+        info = res.info if info is None else info
         r = Record(url=url, title=title, info=info or None)
 
     keyboard = [
@@ -164,9 +208,10 @@ def add_or_delete(update: Update, context: CallbackContext) -> None:
 
     reply_markup = InlineKeyboardMarkup.from_column(keyboard)
     msg = premsg + preview_record(r)
-    update.message.reply_text(msg, reply_markup=reply_markup,
-                              parse_mode=telegram.ParseMode.HTML,
-                              disable_web_page_preview=True)
+    with METRICS.timer('bookmarket_telegram_send_seconds', method='reply_text'):
+        update.message.reply_text(msg, reply_markup=reply_markup,
+                                  parse_mode=telegram.ParseMode.HTML,
+                                  disable_web_page_preview=True)
     return None
 
 
@@ -177,6 +222,9 @@ def preview_record(r):
 
 
 def handle_callback(update: Update, context: CallbackContext) -> None:
+    if update.effective_chat.id not in allowed:
+        return
+
     query = update.callback_query
     query.answer()
 
@@ -192,88 +240,125 @@ def handle_callback(update: Update, context: CallbackContext) -> None:
     if cmd == 'delete':
         delete_callback(update, context)
     if cmd == 'update':
-        update_callback(update, context)
+        job = jobs.submit('update', 'update all entries', update_callback, update, context,
+                          owner=update.effective_chat.id)
+        query.edit_message_text(text=f'Started job #{job.id}, check it with /jobs')
+    if cmd == 'page':
+        page_callback(update, context)
 
     return None
 
 
 def delete_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    try:
-        bm.delete(query.data)
-        query.edit_message_text(text=f"Deleted the record for a current total of {len(bm)} bookmarks")
-    except FileNotFoundError:
-        query.edit_message_text(text='The url does not exists! 🙃')
+    with pool.open(update.effective_chat.id) as chat:
+        try:
+            chat.bm.delete(query.data)
+            query.edit_message_text(text=f"Deleted the record for a current total of {len(chat.bm)} bookmarks")
+        except FileNotFoundError:
+            query.edit_message_text(text='The url does not exists! 🙃')
     return None
 
 
 def add_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    try:
-        bm.write(query.data)
-        query.edit_message_text(text=f"Added the new record for a total of {len(bm)} bookmarks 👍")
-    except FileExistsError:
-        query.edit_message_text(text='The url already exists! 🙃')
+    with pool.open(update.effective_chat.id) as chat:
+        try:
+            chat.bm.write(query.data)
+            query.edit_message_text(text=f"Added the new record for a total of {len(chat.bm)} bookmarks 👍")
+        except FileExistsError:
+            query.edit_message_text(text='The url already exists! 🙃')
     return None
 
 
-def msg_records(update, rs, show_desc=True):
-    for r in sorted(rs):
-        url = sanitize_url(r.url)
-        title = r.title
-        info = r.info
-
-        # TODO probably this part can be removed or differently managed?
-        # They should be already populate on add right?
-        if r.title is None or r.info is None:
-            title, info = find_infos(url)  # TODO
-
-        if r.title is None and title is not None:
-            r_up = replace(r, title=title)
-            bm.update(r_up)
-        if r.info is None and info is not None:
-            r_up = replace(r, info=info)
-            bm.update(r_up)
+def chat_fetch(chat_id, query):
+    """
+    fetch(offset, limit) of a ResultCursor running query(bm, offset, limit) on the chat
+    database, opened again if the pool closed it since the previous page.
+    Records without title / info are queued on the enricher to be filled in the background
+    """
+    def fetch(offset, limit):
+        with pool.open(chat_id) as chat:
+            records = list(query(chat.bm, offset, limit))
+            chat.enricher.extend(r.url for r in records if r.title is None or r.info is None)
+        return records
+    return fetch
+
+
+def page_markup(cursor, i):
+    keyboard = []
+    if i > 0:
+        keyboard.append(InlineKeyboardButton('◀ prev', callback_data=('page', (cursor, i - 1))))
+    if cursor.has_next(i):
+        keyboard.append(InlineKeyboardButton('next ▶', callback_data=('page', (cursor, i + 1))))
+    return InlineKeyboardMarkup([keyboard]) if keyboard else None
+
+
+def msg_records(update, query, show_desc=True):
+    """
+    Send the records returned by query(bm, offset, limit) one page (message) at a time,
+    the cursor is kept in the buttons callback data to move between pages.
+    """
+    cursor = ResultCursor(chat_fetch(update.message.chat_id, query),
+                          lambda r: format_record(replace(r, url=sanitize_url(r.url)), show_desc))
+    page = cursor.page(0)
+    if page is None:
+        update.message.reply_text('Did not find a single thing!')
+        return None
 
-        if title is not None and len(title) > 80:
-            title = title[:80] + '...'
+    with METRICS.timer('bookmarket_telegram_send_seconds', method='reply_text'):
+        update.message.reply_text(text=page, reply_markup=page_markup(cursor, 0),
+                                  parse_mode=telegram.ParseMode.HTML, disable_web_page_preview=True)
+    return None
 
-        msg = f'<b>{title}</b>\n{url}\n{r.human_ts}\n'
-        if r.info is not None and show_desc:
-            info = info[:125].replace('\n', ' ')
-            msg += f'<pre>{info + "..."}</pre>'
 
-        update.message.reply_text(text=msg, parse_mode=telegram.ParseMode.HTML, disable_web_page_preview=False)
+def page_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    cursor, i = query.data
+    with METRICS.timer('bookmarket_telegram_send_seconds', method='edit_message_text'):
+        query.edit_message_text(text=cursor.page(i), reply_markup=page_markup(cursor, i),
+                                parse_mode=telegram.ParseMode.HTML, disable_web_page_preview=True)
+    return None
 
 
 def show_preview(update: Update, context: CallbackContext) -> None:  # TODO
-    if update.message.chat_id != user_id:
+    if update.message.chat_id not in allowed:
         return
 
-    rs = bm.stime(start=time.time() - 60 * 60 * 24 * 14)
-    return None if not rs else msg_records(update, rs)
+    start = time.time() - 60 * 60 * 24 * 14
+    msg_records(update, lambda bm, offset, limit: bm.iter_stime(start=start, limit=limit,
+                                                                offset=offset, reverse=True))
+    return None
 
 
 def show_stats(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id != user_id:
+    if update.message.chat_id not in allowed:
         return
 
     # Show total bookmarks, added today / week / month / year
-    msg = '<b>Bookmarket stats</b> 📊\n'
-    msg += f'Total bookmarks: <b>{len(bm)}</b>\n'
-    today = datetime.now() - timedelta(days=1)
-    msg += f'Added today: <b>{len(bm.stime(start=today))}</b>\n'
-    week = datetime.now() - timedelta(weeks=1)
-    msg += f'Added this week: <b>{len(bm.stime(start=week))}</b>\n'
-    month = datetime.now() - timedelta(days=30)
-    msg += f'Added this month: <b>{len(bm.stime(start=month))}</b>\n'
-    year = datetime.now() - timedelta(days=365)
-    msg += f'Added this year: <b>{len(bm.stime(start=year))}</b>\n'
+    with pool.open(update.message.chat_id) as chat:
+        bm = chat.bm
+        msg = '<b>Bookmarket stats</b> 📊\n'
+        msg += f'Total bookmarks: <b>{len(bm)}</b>\n'
+        today = datetime.now() - timedelta(days=1)
+        msg += f'Added today: <b>{bm.count_time(start=today)}</b>\n'
+        week = datetime.now() - timedelta(weeks=1)
+        msg += f'Added this week: <b>{bm.count_time(start=week)}</b>\n'
+        month = datetime.now() - timedelta(days=30)
+        msg += f'Added this month: <b>{bm.count_time(start=month)}</b>\n'
+        year = datetime.now() - timedelta(days=365)
+        msg += f'Added this year: <b>{bm.count_time(start=year)}</b>\n'
+        msg += f'Query cache hit rate: <b>{bm.queries.stats()["hit_rate"]:.0%}</b>\n'
+    if update.message.chat_id == owner:
+        msg += f'Open databases: <b>{len(pool)}</b> of {len(allowed)} users\n'
     update.message.reply_text(text=msg, parse_mode=telegram.ParseMode.HTML,
                               disable_web_page_preview=False)
 
 
 def update_confirm(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in allowed:
+        return
+
     keyboard = [
         InlineKeyboardButton("You sure?", callback_data=('update', None)),
         InlineKeyboardButton("Cancel", callback_data='cancel'),
@@ -285,10 +370,174 @@ def update_confirm(update: Update, context: CallbackContext) -> None:
                               disable_web_page_preview=True)
     return None
 
-def update_callback(update: Update, context: CallbackContext):
-    update.message.reply_text(text='Updating all entries 👍 give me some slack')
-    bm.update_all()
-    update.message.reply_text(text='Finished updating the entries 👍')
+def update_callback(update: Update, context: CallbackContext, job=None):
+    message = update.effective_message.reply_text(text='Updating all entries 👍 give me some slack')
+    with pool.open(update.effective_chat.id) as chat:
+        step = max(1, len(chat.bm) // 10)
+
+        def progress(ith, total, r):
+            job.progress = f'{ith + 1}/{total}'
+            if (ith + 1) % step == 0 and ith + 1 < total:
+                message.edit_text(text=f'Updating all entries 👍 {ith + 1}/{total} done')
+
+        chat.bm.update_all(progress=progress)
+    update.effective_message.reply_text(text='Finished updating the entries 👍')
+    return None
+
+
+def dedupe_command(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in allowed:
+        return
+
+    job = jobs.submit('update', 'merge duplicates', dedupe, update, context, owner=update.message.chat_id)
+    update.message.reply_text(text=f'Merging the duplicates in job #{job.id}, check it with /jobs')
+    return None
+
+
+def dedupe(update: Update, context: CallbackContext, job=None) -> None:
+    with pool.open(update.message.chat_id) as chat:
+        counts = chat.bm.dedupe()
+    job.progress = ', '.join(f'{k} {v}' for k, v in counts.items())
+    update.message.reply_text(text=f'Removed {counts["removed"]} duplicates of {counts["groups"]} bookmarks 👍')
+    return None
+
+
+def refresh_stale(chat_id, job=None):
+    def progress(ith, total, r):
+        job.progress = f'{ith + 1}/{total}'
+
+    with pool.open(chat_id) as chat:
+        counts = chat.bm.refresh_stale(budget=REFRESH_BUDGET, backoff=backoff, progress=progress)
+    job.progress = ', '.join(f'{k} {v}' for k, v in counts.items())
+    return counts
+
+
+def submit_refresh(chat_id):
+    """
+    Queue a refresh of the stale entries of a chat unless one is already queued or running
+    """
+    active = [j for j in jobs.status(active_only=True, owner=chat_id) if j.kind == 'refresh']
+    if active:
+        return active[0]
+    return jobs.submit('refresh', 'refresh stale entries', refresh_stale, chat_id, owner=chat_id)
+
+
+def refresh_all(context: CallbackContext = None) -> None:
+    # Scheduled, the jobs limit keeps only a couple of databases refreshing (and open) at once
+    for chat_id in sorted(allowed):
+        submit_refresh(chat_id)
+    return None
+
+
+def refresh_command(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in allowed:
+        return
+
+    job = submit_refresh(update.message.chat_id)
+    update.message.reply_text(text=f'Refreshing the stale entries in job #{job.id}, check it with /jobs')
+    return None
+
+
+def handle_document(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in allowed:
+        return
+
+    document = update.message.document
+    job = jobs.submit('import', f'import {document.file_name}', import_document, update, context,
+                      owner=update.message.chat_id)
+    update.message.reply_text(text=f'Importing the bookmarks in job #{job.id}, check it with /jobs')
+    return None
+
+
+def import_document(update: Update, context: CallbackContext, job=None) -> None:
+    # Bookmarks exported by a browser (html / json) or a list of urls
+    document = update.message.document
+    with pool.open(update.message.chat_id) as chat:
+        path = os.path.join(chat.path, f'import_{job.id}_{os.path.basename(document.file_name)}')
+        context.bot.get_file(document.file_id).download(custom_path=path)
+        try:
+            counts = chat.bm.import_bookmarks(path, enricher=chat.enricher)
+        finally:
+            os.remove(path)
+    job.progress = ', '.join(f'{k} {v}' for k, v in counts.items())
+    update.message.reply_text(text=f'Imported {counts["added"]} bookmarks 👍 {counts["duplicates"]} were '
+                                   f'already saved, {counts["skipped"]} are not web links')
+    return None
+
+
+def export_command(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in allowed:
+        return
+
+    fmt = context.args[0] if context.args else 'html'
+    if fmt not in FORMATS:
+        update.message.reply_text(text=f'Use /export with one of {", ".join(FORMATS)}')
+        return None
+    jobs.submit('export', f'export {fmt}', export_document, update, fmt, owner=update.message.chat_id)
+    return None
+
+
+def export_document(update: Update, fmt: str, job=None) -> None:
+    filename = f'bookmarks.{"txt" if fmt == "urls" else fmt}'
+    with pool.open(update.message.chat_id) as chat:
+        path = os.path.join(chat.path, f'export_{job.id}_{filename}')
+        n = chat.bm.export_bookmarks(path, fmt)
+    try:
+        with open(path, 'rb') as f:
+            update.message.reply_document(document=f, filename=filename, caption=f'{n} bookmarks')
+    finally:
+        os.remove(path)
+    job.progress = f'{n} bookmarks'
+    return None
+
+
+def show_jobs(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id not in allowed:
+        return
+
+    status = jobs.status(owner=update.message.chat_id)[-10:]
+    msg = '\n'.join(str(j) for j in status) if status else 'No jobs so far'
+    update.message.reply_text(text=msg)
+    return None
+
+
+def show_metrics(update: Update, context: CallbackContext) -> None:
+    if update.message.chat_id != owner:  # Timings of every chat, only for the owner
+        return
+
+    if not METRICS.enabled:
+        update.message.reply_text(text='Metrics are disabled, start the bot with BOOKMARKET_METRICS=1')
+        return None
+    update.message.reply_text(text=METRICS.summary()[-4000:] or 'Nothing measured yet')
+    return None
+
+
+def setup_metrics() -> None:
+    """
+    Instrumentation is opt-in: BOOKMARKET_METRICS=1 enables it and
+    BOOKMARKET_METRICS_PORT also serves the Prometheus endpoint on localhost
+    """
+    port = os.environ.get('BOOKMARKET_METRICS_PORT')
+    if not (os.environ.get('BOOKMARKET_METRICS') or port):
+        return None
+    METRICS.enable()
+    METRICS.instrument_cache(fetch_cache)
+    METRICS.gauge('bookmarket_open_databases', lambda: len(pool), 'Chat databases open in the pool')
+    METRICS.gauge('bookmarket_enrich_queue', lambda: sum(len(c.enricher) for c in pool.handles()),
+                  'Urls waiting for the enrichers of the open databases')
+    METRICS.gauge('bookmarket_active_jobs', lambda: len(jobs.status(active_only=True)),
+                  'Jobs queued or running')
+    # The chats are instrumented without gauges, these describe every open database by chat id
+    METRICS.gauge('bookmarket_records', lambda: {c.id: len(c.bm) for c in pool.handles()},
+                  'Records in the database', label='chat')
+    METRICS.gauge('bookmarket_db_bytes', lambda: {c.id: c.bm.size_on_disk() for c in pool.handles()},
+                  'Size of the database files', label='chat')
+    METRICS.gauge('bookmarket_query_cache_hit_ratio',
+                  lambda: {c.id: c.bm.queries.stats()['hit_rate'] for c in pool.handles()},
+                  'Share of search / smatch / stime answered by the query cache', label='chat')
+    if port:
+        METRICS.serve(int(port))
+        logger.info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
     return None
 
 
@@ -300,9 +549,19 @@ def handle_invalid_button(update: Update, context: CallbackContext) -> None:
     )
 
 
+def read_allowlist(line: str):
+    """
+    chat_ids of the second line of the key file (separated by commas or spaces),
+    the first one is the owner
+    """
+    ids = [int(i) for i in re.split(r'[,\s]+', line.strip()) if i]
+    if not ids:
+        raise ValueError('Paste at least your chat_id on the second line of the key file')
+    return ids[0], set(ids)
+
 
 def main() -> None:
-    global user_id
+    global owner, allowed
 
     # Check key file
     key_file = 'bookmarket/bot.key'
@@ -314,38 +573,59 @@ def main() -> None:
 
     # Start the bot
     with open(key_file, 'r') as f:
-        key, user_id, *_ = f.read().split('\n')
-        user_id = int(user_id)
+        key, ids, *_ = f.read().split('\n')
+        owner, allowed = read_allowlist(ids)
     updater = Updater(key, arbitrary_callback_data=True)
     updater.bot.set_my_commands([
         ('/p', 'preview last few added bookmarks'),  # TODO
         ('/stats', 'show stats'),
-        ('/updateall', 'update all entries')
+        ('/updateall', 'update all entries'),
+        ('/refresh', 'update the stale entries only'),
+        ('/dedupe', 'merge the bookmarks of the same page'),
+        ('/export', 'download the bookmarks (html, json or urls)'),
+        ('/jobs', 'status of the last jobs'),
+        ('/metrics', 'timings and counters (if enabled)')
     ])
+    setup_metrics()
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
     # on different commands - answer in Telegram
+    def timed(fn, name):  # Handler latency, fn itself if metrics are disabled
+        return METRICS.wrap(fn, 'bookmarket_handler_seconds', handler=name)
+
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("help", start))  # TODO
-    dispatcher.add_handler(CommandHandler("p", show_preview))
-    dispatcher.add_handler(CommandHandler("stats", show_stats))
+    dispatcher.add_handler(CommandHandler("p", timed(show_preview, 'preview')))
+    dispatcher.add_handler(CommandHandler("stats", timed(show_stats, 'stats')))
     dispatcher.add_handler(CommandHandler("updateall", update_confirm))
+    dispatcher.add_handler(CommandHandler("refresh", refresh_command))
+    dispatcher.add_handler(CommandHandler("dedupe", dedupe_command))
+    dispatcher.add_handler(CommandHandler("export", export_command))
+    dispatcher.add_handler(CommandHandler("jobs", show_jobs))
+    dispatcher.add_handler(CommandHandler("metrics", show_metrics))
 
     # Callback with menu
-    dispatcher.add_handler(MessageHandler(Filters.text, handle_msg))
+    dispatcher.add_handler(MessageHandler(Filters.text, timed(handle_msg, 'message')))
+    dispatcher.add_handler(MessageHandler(Filters.document, handle_document))
     dispatcher.add_handler(CallbackQueryHandler(handle_invalid_button,
                                                 pattern=InvalidCallbackData))
-    dispatcher.add_handler(CallbackQueryHandler(handle_callback))
+    dispatcher.add_handler(CallbackQueryHandler(timed(handle_callback, 'callback')))
 
     # Start the Bot
+    updater.job_queue.run_repeating(refresh_all, interval=REFRESH_EVERY, first=60)
+    updater.job_queue.run_repeating(lambda context: pool.sweep(), interval=60)  # Close the idle chats
     updater.start_polling()
 
     # Block until you press Ctrl-C or the process receives SIGINT, SIGTERM or
     # SIGABRT. This should be used most of the time, since start_polling() is
     # non-blocking and will stop the bot gracefully.
     updater.idle()
+    jobs.shutdown()
+    METRICS.shutdown()
+    pool.close_all()
+    fetch_cache.save()
 
 
 if __name__ == '__main__':
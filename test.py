@@ -1,13 +1,143 @@
 import unittest
+from unittest import mock
+import os
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import dataclasses
+import json
+import io
+import random
+import shutil
+from urllib.request import urlopen
 from dataclasses import asdict
 from datetime import datetime
-from bookmarket.bookmarket import Bookmarket, Record
+from tinydb import Query
+from bookmarket.storage import migrate
+from bookmarket import formats
+from bookmarket.pages import ResultCursor
+from bookmarket.jobs import Jobs
+from bookmarket.pool import HandlePool
+from bookmarket.canonical import Canonicalizer
+from bookmarket.archive import PageArchive
+from bookmarket.metrics import Metrics, METRICS
+from bookmarket.bookmarket import (Bookmarket, Record, FetchCache, Enricher, HostBackoff, fetch, find_infos,
+                                   read_head)
+Q = Query()
+
+
+class SlowSite(BaseHTTPRequestHandler):
+    """Local stand-in for the sites we scrape, answers after `delay` seconds"""
+    delay = 0.1
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = (f'<html><head><title>page {self.path}</title>'
+                f'<meta property="og:description" content="about {self.path}"></head>'
+                '<body></body></html>').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EtagSite(SlowSite):
+    """Answers 304 when the client already has the current version of the page"""
+    delay = 0
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.headers.get('If-None-Match') == f'"{self.path}"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f'<html><head><title>page {self.path}</title></head></html>'.encode()
+        self.send_response(200)
+        self.send_header('ETag', f'"{self.path}"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RedirectSite(SlowSite):
+    """Redirects /old/* to /new/*, one request per url is counted"""
+    delay = 0
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path.startswith('/old'):
+            self.send_response(301)
+            self.send_header('Location', self.path.replace('/old', '/new'))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+class PageSite(SlowSite):
+    """Pages with some text in the body, /same* pages all have the same text"""
+    delay = 0
+
+    def do_GET(self):
+        word = 'kangaroo' if self.path.startswith('/same') else self.path.strip('/')
+        body = (f'<html><head><title>page {self.path}</title><style>p {{color: red}}</style></head>'
+                f'<body><p>All about   {word}</p><script>var hidden = 1;</script><p>the end</p></body>'
+                '</html>').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BrokenSite(SlowSite):
+    """/dead is not found and /broken is a server error, the other pages are fine"""
+    delay = 0
+
+    def do_GET(self):
+        if self.path in ('/dead', '/broken'):
+            self.send_response(404 if self.path == '/dead' else 500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+class FakeResponse:
+    """Response whose body is produced chunk by chunk, counts the chunks read"""
+    def __init__(self, chunks, content_type='text/html'):
+        self.headers = {'Content-Type': content_type}
+        self.encoding = 'utf-8'
+        self.chunks = chunks
+        self.read = 0
+
+    def iter_content(self, chunk_size=1):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+
+def blob_files(root):
+    return [f for _, _, files in os.walk(os.path.join(root, 'blobs')) for f in files]
+
+
+def serve(handler=SlowSite):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
 
 
 class TestDB(unittest.TestCase):
+    path = '/tmp/bookmarket_db_test.py'
+
     def setUp(self):
-        self.bm = Bookmarket('/tmp/bookmarket_db_test.py')
+        self.bm = Bookmarket(self.path)
         self.bm.truncate()
 
     def tearDown(self):
@@ -81,6 +211,12 @@ class TestDB(unittest.TestCase):
                 self.assertEqual(res, None)
             else:
                 self.assertEqual(set(res), set(exp_res[i]))
+            self.assertEqual(self.bm.count_time(t0, t1), len(exp_res[i]))
+
+        # Ranges follow timestamp updates
+        self.bm.update(Record(url=r2012.url, ts=datetime.timestamp(datetime(2019, 1, 1))))
+        self.assertEqual(self.bm.count_time(None, datetime(2014, 1, 1)), 0)
+        self.assertEqual(self.bm.stime(datetime(2018, 6, 1))[0].url, r2012.url)
 
     def test_update(self):
         ts0 = datetime.timestamp(datetime(2010, 1, 1))
@@ -141,6 +277,938 @@ class TestDB(unittest.TestCase):
         r_up = Record(url='https://www.notexist.com', info='fake')
         self.assertFalse(self.bm.update(r_up))
 
+    def test_search_text(self):
+        r0 = Record(url='https://www.google.com', title='just google', info='A search engine', ts=1.0)
+        r1 = Record(url='https://arxiv.org/abs/1706.03762', title='Attention is all you need', info=None, ts=2.0)
+        r2 = Record(url='https://www.facebook.com', title='just facebook', info='happy sad', ts=3.0)
+        self.bm.write([r0, r1, r2])
+
+        self.assertEqual(self.bm.search_text('google'), [r0])
+        self.assertEqual(self.bm.search_text('JUST'), [r0, r2])
+        self.assertEqual(self.bm.search_text('just', 'happy'), [r2])
+        self.assertEqual(self.bm.search_text('atten', 'arxiv.org'), [r1])
+        self.assertEqual(self.bm.search_text('notfound'), [])
+        self.assertEqual(len(self.bm.search_text()), 3)
+
+        # '_' is part of a token, as in identifiers
+        r3 = Record(url='https://example.com/naming', title='snake_case names', ts=4.0)
+        self.bm.write(r3)
+        self.assertEqual(self.bm.search_text('snake_case'), [r3])
+        self.assertEqual(self.bm.search_text('snake'), [r3])
+        self.assertEqual(self.bm.search_text('case'), [])
+        self.bm.delete(r3)
+
+        # The index follows updates and deletes
+        self.bm.update(Record(url=r0.url, info='happy engine'))
+        self.assertEqual(self.bm.search_text('happy'), [self.bm.get(Q.url == r0.url), r2])
+        self.bm.delete(r2)
+        self.assertEqual(self.bm.search_text('facebook'), [])
+        self.assertEqual(len(self.bm.search_text('happy')), 1)
+
+        # And is rebuilt when the database is reopened
+        self.bm.close()
+        self.bm = Bookmarket(self.path)
+        self.assertEqual(self.bm.search_text('need'), [r1])
+
+    def test_search_ranked(self):
+        self.bm.write([
+            Record(url='www.a.com', title='cooking pasta', info='italian recipes', ts=1.0),
+            Record(url='www.b.com', title='pasta pasta pasta', info='more pasta', ts=2.0),
+            Record(url='www.c.com', title='travel', info='eating pasta in rome', ts=3.0),
+            Record(url='www.d.com', title='rust book', info='systems programming', ts=4.0),
+        ])
+        self.assertEqual([r.url for r in self.bm.search_ranked('pasta')], ['www.b.com', 'www.a.com', 'www.c.com'])
+        self.assertEqual([r.url for r in self.bm.search_ranked('pasta', k=1)], ['www.b.com'])
+        self.assertEqual([r.url for r in self.bm.search_ranked('rome', 'rust')], ['www.d.com', 'www.c.com'])
+        self.assertEqual([r.url for r in self.bm.search_ranked('prog')], ['www.d.com'])
+        self.assertEqual(self.bm.search_ranked('nothing'), [])
+        self.assertEqual(self.bm.search_ranked(), [])
+
+        # The index follows the writes
+        self.bm.delete(Record(url='www.b.com'))
+        self.bm.update(Record(url='www.d.com', title='pasta pasta'))
+        self.bm.write(Record(url='www.e.com', title='fresh pasta', ts=5.0))
+        self.assertEqual([r.url for r in self.bm.search_ranked('pasta')][0], 'www.d.com')
+        self.assertEqual({r.url for r in self.bm.search_ranked('pasta')},
+                         {'www.a.com', 'www.c.com', 'www.d.com', 'www.e.com'})
+        with self.assertRaises(FileExistsError):
+            self.bm.write([Record(url='www.f.com', title='pasta'), Record(url='www.a.com')])
+        self.assertNotIn('www.f.com', [r.url for r in self.bm.search_ranked('pasta')])
+
+    def test_search_ranked_prefix(self):
+        a = Record(url='https://a.com', title='programming in rust', ts=1.0)
+        b = Record(url='https://b.com', title='tv program guide', ts=2.0)
+        self.bm.write(a)
+        self.assertEqual(self.bm.search_ranked('program'), [a])
+
+        # A keyword indexed as a whole token still matches the longer ones, before and after a rebuild
+        self.bm.write(b)
+        self.assertEqual({r.url for r in self.bm.search_ranked('program')}, {a.url, b.url})
+        self.bm._ranking = None
+        self.bm.queries.clear()
+        self.assertEqual({r.url for r in self.bm.search_ranked('program')}, {a.url, b.url})
+        self.assertEqual(self.bm.search_ranked('programming'), [a])
+
+    def test_dedupe(self):
+        docs = [('http://www.a.com/page/?utm_source=x', None, 'about a', 1.0),
+                ('https://a.com/page', 'A page', None, 2.0),
+                ('https://a.com/page#top', 'other title', 'other', 3.0),
+                ('https://b.com/old', None, None, 4.0),
+                ('https://b.com/new', 'B', None, 5.0)]
+        with self.bm.batch():  # Saved before duplicates were checked by canonical key
+            for url, title, info, ts in docs:
+                self.bm.storage.insert(Record(url=url, title=title, info=info, ts=ts).to_doc())
+
+        with self.assertRaises(FileExistsError):
+            self.bm.write(Record(url='https://A.com/page/', ts=6.0))
+        self.assertEqual(self.bm.get_canonical('http://a.com/page').url, 'http://www.a.com/page/?utm_source=x')
+        self.assertIsNone(self.bm.get_canonical('https://a.com/other'))
+
+        self.bm.cache = FetchCache()  # Knows that /old redirects to /new
+        self.bm.cache.put('https://b.com/old', 'B', None, final_url='https://b.com/new')
+        self.assertEqual(self.bm.dedupe(), {'groups': 2, 'removed': 3})
+        self.assertEqual([(r.url, r.title, r.info) for r in self.bm.iter_all(order='ts')],
+                         [('http://www.a.com/page/?utm_source=x', 'A page', 'about a'),
+                          ('https://b.com/old', 'B', None)])
+        self.assertEqual(self.bm.dedupe(), {'groups': 0, 'removed': 0})
+
+        self.bm.delete(Record(url='http://www.a.com/page/?utm_source=x'))
+        self.assertIsNone(self.bm.get_canonical('https://a.com/page'))
+        self.bm.write(Record(url='https://a.com/page'))
+
+    def test_import_export(self):
+        html = """<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<DL><p>
+    <DT><H3>Folder</H3>
+    <DL><p>
+        <DT><A HREF="https://arxiv.org/pdf/1706.03762.pdf" ADD_DATE="1600000000">Attention</A>
+        <DD>is all you need
+        <DT><A HREF="https://www.python.org" ADD_DATE="1600000001">Python &amp; co</A>
+    </DL><p>
+    <DT><A HREF="javascript:alert(1)">bookmarklet</A>
+    <DT><A HREF="https://www.python.org">again</A>
+</DL><p>"""
+        self.bm.write(Record(url='https://www.rust-lang.org', title='Rust', ts=1.0))
+        counts = self.bm.import_bookmarks(io.StringIO(html))
+        self.assertEqual(counts, {'added': 2, 'duplicates': 1, 'skipped': 1})
+        r = self.bm.get_url('https://arxiv.org/abs/1706.03762')
+        self.assertEqual((r.title, r.info, r.ts), ('Attention', 'is all you need', 1600000000.0))
+        self.assertEqual(self.bm.get_url('https://www.python.org').title, 'Python & co')
+
+        firefox = json.dumps({'title': '', 'children': [
+            {'title': 'menu', 'typeCode': 2, 'children': [
+                {'title': 'Rust', 'uri': 'https://www.rust-lang.org', 'dateAdded': 1600000002000000},
+                {'title': 'Docs', 'uri': 'https://docs.python.org', 'dateAdded': 1600000003000000,
+                 'annos': [{'name': 'bookmarkProperties/description', 'value': 'x'}]}]}]})
+        enricher = Enricher(self.bm)
+        self.assertEqual(self.bm.import_bookmarks(io.StringIO(firefox), enricher=enricher)['added'], 1)
+        self.assertEqual(self.bm.get_url('https://docs.python.org').ts, 1600000003.0)
+        self.assertEqual(len(enricher), 1)
+        urls = '# my links\nhttps://a.com A site\n\nhttps://b.com\nftp://c.com\n'
+        self.assertEqual(self.bm.import_bookmarks(io.StringIO(urls)), {'added': 2, 'duplicates': 0, 'skipped': 1})
+
+        # Export and import back, also in small chunks
+        formats.CHUNK_SIZE = 16
+        self.addCleanup(setattr, formats, 'CHUNK_SIZE', 64 * 1024)
+        for fmt in formats.FORMATS:
+            out = io.StringIO()
+            self.assertEqual(self.bm.export_bookmarks(out, fmt), 6)
+            docs = list(formats.read(io.StringIO(out.getvalue())))
+            self.assertEqual([d['url'] for d in docs], [r.url for r in self.bm.iter_all(order='ts')])
+            if fmt != 'urls':
+                self.assertEqual([d['ts'] for d in docs][:4], [1.0, 1600000000.0, 1600000001.0, 1600000003.0])
+                self.assertEqual(docs[0]['title'], 'Rust')
+
+    def test_concurrency(self):
+        # Records are always written, updated and deleted in pairs within a batch:
+        # every read must see both records of a pair or none
+        n_writers, n_pairs = 4, 30
+        errors, done = [], threading.Event()
+
+        def pair(t, i, title):
+            return [Record(url=f'www.w{t}.com/{i}/{side}', title=f'{title} k{t}_{i}_e', ts=float(t * 1000 + i))
+                    for side in 'ab']
+
+        def writer(t):
+            try:
+                for i in range(n_pairs):
+                    self.bm.write(pair(t, i, 'new'))
+                    with self.bm.batch():
+                        for r in pair(t, i, 'updated'):
+                            self.bm.update(r)
+                    if i % 2:
+                        with self.bm.batch():
+                            for r in pair(t, i, 'gone'):
+                                self.bm.delete(r)
+            except Exception as e:
+                errors.append(e)
+
+        def reader(seed):
+            rng = random.Random(seed)
+            try:
+                while not done.is_set():
+                    t, i = rng.randrange(n_writers), rng.randrange(n_pairs)
+                    key = f'k{t}_{i}_e'
+                    found = self.bm.search_text(key)
+                    self.assertIn(len(found), (0, 2))
+                    self.assertEqual(len({r.title for r in found}), min(1, len(found)))
+                    self.assertIn(len(self.bm.smatch(Record(title=f'updated {key}'))), (0, 2))
+                    self.assertEqual(len(self.bm.stime()) % 2, 0)
+                    self.assertEqual(len(self.bm.all()) % 2, 0)
+                    self.assertEqual(self.bm.count_time() % 2, 0)
+                    self.assertEqual(len(self.bm) % 2, 0)
+                    self.assertIn(len([r for r in self.bm.search_ranked(key, k=100) if key in r.title]), (0, 2))
+                    a = self.bm.get_url(f'www.w{t}.com/{i}/a')
+                    list(self.bm.iter_text('updated', limit=50))
+                    if a is not None:
+                        self.assertIn(f'www.w{t}.com/{i}/b', self.bm)
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=reader, args=(i,)) for i in range(6)]
+        writers = [threading.Thread(target=writer, args=(t,)) for t in range(n_writers)]
+        for th in readers + writers:
+            th.start()
+        for th in writers:
+            th.join()
+        done.set()
+        for th in readers:
+            th.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.bm), n_writers * n_pairs)
+        self.assertEqual(len(self.bm.search_text('updated')), n_writers * n_pairs)
+
+    def test_query_cache(self):
+        now = time.time()
+        self.bm.write([Record(url=f'www.site{i}.com', title=f'site {i}', ts=now - 10 + i) for i in range(3)])
+        self.assertEqual(len(self.bm.stime()), 3)
+        self.assertEqual(len(self.bm.stime()), 3)
+        self.assertEqual(len(self.bm.search(Q.title == 'site 1')), 1)
+        self.assertEqual(len(self.bm.search((Q.title == 'site 1') | (Q.ts < 0))), 1)
+        self.assertEqual(len(self.bm.search((Q.ts < 0) | (Q.title == 'site 1'))), 1)
+        self.assertEqual(self.bm.search_text('SITE'), self.bm.search_text('site'))
+        self.assertEqual(self.bm.queries.stats()['hits'], 3)
+
+        # Writes invalidate every cached result
+        self.bm.update(Record(url='www.site1.com', title='renamed'))
+        self.assertEqual(self.bm.search(Q.title == 'site 1'), [])
+        self.assertEqual(len(self.bm.search_text('renamed')), 1)
+        self.assertEqual(self.bm.smatch(Record(title='renamed'))[0].url, 'www.site1.com')
+        self.bm.delete(Record(url='www.site0.com'))
+        self.assertEqual(len(self.bm.stime()), 2)
+        self.assertEqual(self.bm.smatch(Record(title='renamed'))[0].url, 'www.site1.com')
+
+        # Open ended ranges see the records whose ts was in the future when cached
+        self.bm.write(Record(url='www.soon.com', ts=time.time() + 0.2))
+        self.assertEqual(len(self.bm.stime()), 2)
+        time.sleep(0.3)
+        self.assertEqual(len(self.bm.stime()), 3)
+        self.assertEqual(len(self.bm.stime(end=now)), 2)
+        self.bm.truncate()
+        self.assertEqual(self.bm.stime(), [])
+        self.assertGreater(self.bm.queries.stats()['hit_rate'], 0)
+
+    def test_url_index(self):
+        r = Record(url='https://www.google.com', title='just google', info='A bookmark', ts=1.0)
+        r2 = Record(url='https://www.facebook.com', title='just facebook', info='happy sad', ts=2.0)
+        self.bm.write([r, r2])
+        self.assertEqual(self.bm.get_url(r.url), r)
+        self.assertIn(r2.url, self.bm)
+        self.assertIsNone(self.bm.get_url('https://notfound.org'))
+
+        # Duplicates are detected within the same write too
+        r3 = Record(url='https://www.apple.com', ts=3.0)
+        with self.assertRaises(FileExistsError):
+            self.bm.write([r3, r3])
+        self.assertNotIn(r3.url, self.bm)
+
+        self.bm.delete(r)
+        self.assertNotIn(r.url, self.bm)
+        self.assertIsNone(self.bm.get(Q.url == r.url))
+        with self.assertRaises(FileNotFoundError):
+            self.bm.delete(r)
+        self.bm.write(r)
+        self.assertEqual(self.bm.get_url(r.url), r)
+
+        # Rejected before any change, the storage has nothing to roll back
+        rollbacks = []
+        rollback = self.bm.storage.rollback
+        self.bm.storage.rollback = lambda: rollbacks.append(1) or rollback()
+        with self.assertRaises(FileExistsError):
+            self.bm.write([r3, Record(url='http://apple.com/?utm_source=x')])
+        with self.assertRaises(FileExistsError):
+            self.bm.write(r)
+        with self.assertRaises(FileNotFoundError):
+            self.bm.delete(r3)
+        self.assertEqual(rollbacks, [])
+        self.assertNotIn(r3.url, self.bm)
+
+    def test_batch(self):
+        rs = [Record(url=f'https://www.site{i}.com', title=f'site {i}', ts=float(i)) for i in range(10)]
+        flushes = self.bm.storage.flushes
+
+        with self.bm.batch():
+            self.bm.write(rs[:5])
+            self.bm.write(rs[5:])
+            self.bm.update(Record(url=rs[0].url, title='updated'))
+            self.bm.delete(rs[1])
+            self.assertEqual(self.bm.storage.flushes, flushes)
+        self.assertEqual(self.bm.storage.flushes, flushes + 1)
+        self.assertEqual(len(self.bm), 9)
+        self.assertEqual(self.bm.get(Q.url == rs[0].url).title, 'updated')
+        self.assertIsNone(self.bm.get(Q.url == rs[1].url))
+
+        # A failing batch commits nothing and leaves the indexes untouched
+        with self.assertRaises(FileExistsError):
+            with self.bm.batch():
+                self.bm.delete(rs[2])
+                self.bm.write(Record(url='https://www.new.com'))
+                self.bm.write(rs[3])
+        self.assertEqual(self.bm.storage.flushes, flushes + 1)
+        self.assertEqual(len(self.bm), 9)
+        self.assertIn(rs[2].url, self.bm)
+        self.assertNotIn('https://www.new.com', self.bm)
+        self.assertEqual(self.bm.search_text('new'), [])
+
+        # Updating an unknown url does not touch the disk
+        self.assertFalse(self.bm.update(Record(url='https://www.notexist.com', info='fake')))
+        self.assertEqual(self.bm.storage.flushes, flushes + 1)
+
+    def test_update_all(self):
+        server, base = serve()
+        self.addCleanup(server.shutdown)
+        n = 8
+        self.bm.write([Record(url=f'{base}/{i}', ts=float(i)) for i in range(n)])
+        self.bm.write(Record(url=f'{base}/paper.pdf', title='keep me', ts=float(n)))
+
+        t0 = time.perf_counter()
+        self.bm.update_all(workers=1, progress=lambda *args: None)
+        serial = time.perf_counter() - t0
+        self.assertEqual(self.bm.get_url(f'{base}/3').title, 'page /3')
+        self.assertEqual(self.bm.get_url(f'{base}/3').info, 'about /3')
+        self.assertNotIn(f'{base}/paper.pdf', self.bm)
+        self.assertEqual(self.bm.get_url(f'{base}/paper').title, 'page /paper')
+
+        seen = []
+        t0 = time.perf_counter()
+        self.bm.update_all(workers=8, per_host=8, batch_size=4, progress=lambda *args: seen.append(args))
+        concurrent = time.perf_counter() - t0
+        self.assertEqual(len(seen), n + 1)
+        self.assertEqual(len(self.bm), n + 1)
+        self.assertLess(concurrent, serial / 2)
+
+        # A record deleted while it is fetched is not written back under its new url
+        def delete_gone(ith, total, r):
+            if r.url == f'{base}/gone':
+                self.bm.delete(Record(url=f'{base}/gone.pdf'))
+        self.bm.write(Record(url=f'{base}/gone.pdf', ts=float(n + 1)))
+        self.bm.update_all(workers=1, progress=delete_gone)
+        self.assertNotIn(f'{base}/gone', self.bm)
+        self.assertEqual(len(self.bm), n + 1)
+
+    def test_archive(self):
+        server, base = serve(PageSite)
+        self.addCleanup(server.shutdown)
+        root = '/tmp/bookmarket_archive_test'
+        shutil.rmtree(root, ignore_errors=True)
+        self.bm.archive = PageArchive(root, compression='gzip')
+        self.bm.cache = FetchCache()
+        self.bm.write([Record(url=f'{base}/{path}', ts=float(i))
+                       for i, path in enumerate(('wombat', 'same1', 'same2'))])
+        self.bm.cache.put(f'{base}/wombat', 'cached', None, etag='x')  # Not archived yet, still downloaded
+        self.bm.update_all(progress=lambda *args: None)
+
+        self.assertEqual(len(self.bm.archive), 3)
+        self.assertEqual(len(blob_files(root)), 2)  # The same text is stored once
+        self.assertEqual(self.bm.page_text(f'{base}/wombat'), 'All about wombat\nthe end')
+        self.assertEqual([r.url for r in self.bm.search_pages('kangar')], [f'{base}/same1', f'{base}/same2'])
+        self.assertEqual(self.bm.search_pages('about', 'wombat')[0].title, 'page /wombat')
+        self.assertEqual(self.bm.search_pages('hidden'), [])  # Scripts are not text
+
+        # Deleted records leave the archive, dead links keep their text
+        self.bm.delete(Record(url=f'{base}/same2'))
+        self.assertEqual(len(self.bm.archive), 2)
+        server.shutdown()
+        server.server_close()
+        self.bm.update_all(progress=lambda *args: None)
+        self.assertEqual(self.bm.get_url(f'{base}/wombat').status, 0)
+        self.assertEqual([r.url for r in self.bm.search_pages('wombat')], [f'{base}/wombat'])
+
+        # A failure of the archive does not undo the committed delete
+        def remove(url):
+            raise OSError('archive unavailable')
+        self.bm.archive.remove = remove
+        with self.assertRaises(OSError):
+            self.bm.delete(Record(url=f'{base}/same1'))
+        self.assertNotIn(f'{base}/same1', self.bm)
+        self.assertEqual(len(self.bm), 1)
+
+    def test_refresh_stale(self):
+        server, base = serve()
+        self.addCleanup(server.shutdown)
+        down, down_base = serve()
+        down.shutdown()
+        down.server_close()
+        now = time.time()
+        self.bm.write([Record(url=f'{base}/new{i}', ts=float(i)) for i in range(3)])
+        self.bm.write(Record(url=f'{base}/fresh', title='fresh', ts=3.0, fetched=now, status=200, failures=0))
+        self.bm.write(Record(url=f'{base}/stale', title='stale', ts=4.0, fetched=now - 100, status=200))
+        self.bm.write(Record(url=f'{down_base}/gone', ts=5.0))
+        quiet = {'progress': lambda *args: None}
+
+        # Never fetched records come first, the budget stops the run
+        path = '/tmp/bookmarket_backoff_test.json'
+        if os.path.isfile(path):
+            os.remove(path)
+        backoff = HostBackoff(path, base=60)
+        counts = self.bm.refresh_stale(max_age=50, budget=2, backoff=backoff, **quiet)
+        self.assertEqual(counts, {'refreshed': 2, 'failed': 0, 'skipped': 0, 'remaining': 3})
+        r = self.bm.get_url(f'{base}/new0')
+        self.assertEqual((r.title, r.status, r.failures), ('page /new0', 200, 0))
+        self.assertGreaterEqual(r.fetched, now)
+
+        # The next run resumes from what is still due
+        counts = self.bm.refresh_stale(max_age=50, backoff=backoff, **quiet)
+        self.assertEqual(counts, {'refreshed': 2, 'failed': 1, 'skipped': 0, 'remaining': 0})
+        self.assertEqual(self.bm.get_url(f'{base}/stale').title, 'page /stale')
+        self.assertEqual(self.bm.get_url(f'{base}/fresh').title, 'fresh')
+        gone = self.bm.get_url(f'{down_base}/gone')
+        self.assertEqual((gone.status, gone.failures), (0, 1))
+
+        # The failed host backs off, also after a restart
+        self.assertFalse(HostBackoff(path).ready(gone.url.split('/')[2]))
+        self.bm.update(Record(url=gone.url, fetched=now - 1000))
+        counts = self.bm.refresh_stale(max_age=50, backoff=backoff, **quiet)
+        self.assertEqual(counts, {'refreshed': 0, 'failed': 0, 'skipped': 1, 'remaining': 0})
+
+    def test_refresh_stale_backoff(self):
+        server, base = serve(BrokenSite)
+        self.addCleanup(server.shutdown)
+        broken, broken_base = serve(BrokenSite)
+        self.addCleanup(broken.shutdown)
+        self.bm.write(Record(url=f'{base}/dead', ts=0.0))
+        self.bm.write(Record(url=f'{broken_base}/broken', ts=1.0))
+        self.bm.write([Record(url=f'{b}/{i}', ts=2.0 + i + j / 10)
+                       for j, b in enumerate((base, broken_base)) for i in range(5)])
+        backoff = HostBackoff(base=60)
+
+        # A missing page only fails its record, a server error backs off the whole host,
+        # the records of that host not fetched yet are skipped
+        counts = self.bm.refresh_stale(max_age=50, backoff=backoff, workers=1, per_host=1,
+                                       progress=lambda *args: None)
+        self.assertEqual(counts, {'refreshed': 5, 'failed': 2, 'skipped': 5, 'remaining': 0})
+        self.assertTrue(backoff.ready(base.split('/')[2]))
+        self.assertFalse(backoff.ready(broken_base.split('/')[2]))
+        self.assertEqual(self.bm.get_url(f'{base}/dead').failures, 1)
+        self.assertEqual(self.bm.get_url(f'{base}/4').title, 'page /4')
+
+    def test_enricher(self):
+        server, base = serve()
+        self.addCleanup(server.shutdown)
+        path = '/tmp/bookmarket_enrich_test.json'
+        if os.path.isfile(path):
+            os.remove(path)
+        self.bm.write([Record(url=f'{base}/{i}', ts=float(i)) for i in range(5)])
+        self.bm.write(Record(url=f'{base}/mine', title='my title', ts=5.0))
+
+        enricher = Enricher(self.bm, path, batch_size=4)
+        for i in range(5):
+            self.assertTrue(enricher.add(f'{base}/{i}'))
+        self.assertFalse(enricher.add(f'{base}/0'))
+        enricher.add(f'{base}/mine')
+
+        # The queue survives a restart
+        enricher = Enricher(self.bm, path, batch_size=4)
+        self.assertEqual(len(enricher), 6)
+
+        flushes = self.bm.storage.flushes
+        enricher.start()
+        deadline = time.time() + 10
+        while len(enricher) and time.time() < deadline:
+            time.sleep(0.05)
+        enricher.stop()
+        self.assertEqual(len(enricher), 0)
+        self.assertEqual(self.bm.storage.flushes, flushes + 2)
+        self.assertEqual(self.bm.get_url(f'{base}/3').title, 'page /3')
+        self.assertEqual(self.bm.get_url(f'{base}/mine').title, 'my title')
+        self.assertEqual(self.bm.get_url(f'{base}/mine').info, 'about /mine')
+        self.assertEqual(len(Enricher(self.bm, path)), 0)
+
+    def test_iter(self):
+        rs = [Record(url=f'https://www.site{i}.com', title=f'site {i % 2}', ts=float(10 - i)) for i in range(10)]
+        self.bm.write(rs)
+
+        self.assertEqual(list(self.bm.iter_all()), rs)
+        self.assertEqual(list(self.bm.iter_all(limit=3, offset=2)), rs[2:5])
+        self.assertEqual(list(self.bm.iter_all(order='ts')), rs[::-1])
+        self.assertEqual(list(self.bm.iter_all(limit=2, order='-ts')), rs[:2])
+        self.assertEqual(list(self.bm.iter_search(Q.title == 'site 1', limit=2)), [rs[1], rs[3]])
+        self.assertEqual(list(self.bm.iter_text('site', '0', order='ts', limit=2)), [rs[8], rs[6]])
+        self.assertEqual(list(self.bm.iter_stime(2, 6, reverse=True)), rs[5:9])
+        self.assertEqual(list(self.bm.iter_stime(2, 6, offset=1, limit=1)), [rs[7]])
+        with self.assertRaises(ValueError):
+            self.bm.iter_all(order='title')
+
+        # Iterating while the database changes does not break
+        for r in self.bm.iter_all():
+            self.bm.delete(r)
+        self.assertEqual(len(self.bm), 0)
+
+
+class TestRecord(unittest.TestCase):
+    def test_from_doc(self):
+        doc = {'url': 'https://www.google.com', 'title': 'just google', 'info': None, 'ts': 1.0,
+               'fetched': None, 'status': None, 'failures': None}
+        r = Record.from_doc(doc)
+        self.assertEqual(Record.from_doc({'url': doc['url'], 'title': doc['title'], 'ts': 1.0}).to_doc(), doc)
+        self.assertEqual(asdict(r), doc)
+        self.assertEqual(r.to_doc(), doc)
+        self.assertEqual(r.query_dict(), {'url': doc['url'], 'title': doc['title'], 'ts': 1.0})
+        self.assertEqual(hash(r), hash(Record(**doc)))
+        self.assertLess(Record.from_doc({'url': 'x', 'ts': 0.5}), r)
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            r.title = 'changed'
+
+
+class TestCanonical(unittest.TestCase):
+    def test_key(self):
+        key = Canonicalizer()
+        self.assertEqual(key('http://WWW.Site.com:80/page/?utm_source=x&b=2&fbclid=1&a=#top'),
+                         'https://site.com/page?a=&b=2')
+        self.assertEqual(key('https://site.com/docs/index.html'), key('https://site.com/docs'))
+        self.assertEqual(key('https://arxiv.org/pdf/1706.03762.pdf'), 'https://arxiv.org/abs/1706.03762')
+        self.assertNotEqual(key('https://site.com/a?page=2'), key('https://site.com/a?page=3'))
+
+        # Only the chosen steps run, custom ones are functions of the split url
+        key = Canonicalizer(steps=('host', 'www', lambda parts, canon: parts._replace(query='')))
+        self.assertEqual(key('http://www.Site.com/Page/?id=1#top'), 'http://site.com/Page/#top')
+        with self.assertRaises(ValueError):
+            Canonicalizer(steps=('host', 'nope'))
+
+
+class TestArchive(unittest.TestCase):
+    root = '/tmp/bookmarket_archive_unit_test'
+
+    def setUp(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_eviction(self):
+        archive = PageArchive(self.root, max_bytes=1000, max_page_chars=2000, compression='gzip')
+        self.addCleanup(archive.close)
+        rng = random.Random(0)
+        texts = {f'https://site.com/{i}': ' '.join(rng.choice(['alpha', 'beta', 'gamma', 'delta']) + str(i)
+                                                   for _ in range(1000)) for i in range(10)}
+        for url, text in texts.items():
+            archive.put(url, text)
+            self.assertLessEqual(archive.bytes, 1000)
+        self.assertLess(len(archive), 10)
+        self.assertIn('https://site.com/9', archive)  # The least recently used went first
+        self.assertNotIn('https://site.com/0', archive)
+        self.assertEqual(archive.get('https://site.com/9'), texts['https://site.com/9'][:2000])
+        self.assertEqual(archive.search(['alpha0']), [])  # Evicted texts leave the index
+
+        # Reopened, texts are still there
+        archive.close()
+        archive = PageArchive(self.root, max_bytes=1000, compression='gzip')
+        self.assertEqual([url for url, _ in archive.search(['gamma9'])], ['https://site.com/9'])
+        blobs = len(blob_files(self.root))
+        self.assertEqual(archive.evict(0), blobs)
+        self.assertEqual((len(archive), archive.bytes, blob_files(self.root)), (0, 0, []))
+        archive.close()
+
+    def test_compression(self):
+        with self.assertRaises(ValueError):
+            PageArchive(self.root, compression='lz4')
+        archive = PageArchive(self.root, compression='gzip')
+        self.addCleanup(archive.close)
+        digest = archive.put('https://a.com', 'some text ' * 1000)
+        with open(os.path.join(self.root, 'blobs', digest[:2], digest), 'rb') as f:
+            blob = f.read()
+        self.assertEqual(blob[:2], b'\x1f\x8b')
+        self.assertLess(len(blob), 200)
+        self.assertTrue(archive.remove('https://a.com'))
+        self.assertFalse(os.path.isfile(os.path.join(self.root, 'blobs', digest[:2], digest)))
+        self.assertEqual(archive.bytes, 0)
+
+
+class TestPages(unittest.TestCase):
+    def test_cursor(self):
+        rs = [Record(url=f'https://www.site{i}.com', title=f'<site {i}>', info='x' * 200, ts=float(i)) for i in range(50)]
+        calls = []
+
+        def fetch(offset, limit):
+            calls.append((offset, limit))
+            return iter(rs[offset:offset + limit])
+
+        cursor = ResultCursor(fetch, limit=1000)
+        first = cursor.page(0)
+        self.assertIn('&lt;site 0&gt;', first)
+        self.assertLessEqual(len(first), 1000)
+        self.assertEqual(calls, [(0, 10)])  # Only what the first page needs
+        self.assertTrue(cursor.has_next(0))
+
+        pages = [first]
+        while cursor.has_next(len(pages) - 1):
+            pages.append(cursor.page(len(pages)))
+        self.assertTrue(all(len(p) <= 1000 for p in pages))
+        self.assertEqual(sum(p.count('<b>') for p in pages), len(rs))
+        self.assertEqual(cursor.page(0), first)
+        self.assertIsNone(cursor.page(len(pages)))
+        self.assertIsNone(ResultCursor(lambda offset, limit: iter([])).page(0))
+
+
+class TestJobs(unittest.TestCase):
+    def test_limits(self):
+        jobs = Jobs(workers=4, limits={'slow': 1}, history=3)
+        self.addCleanup(jobs.shutdown)
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def slow(job=None):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            job.progress = 'half way'
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return job.id
+
+        submitted = [jobs.submit('slow', f'job {i}', slow) for i in range(3)]
+        fast = jobs.submit('fast', 'quick one', lambda: 'ok')
+        self.assertEqual(fast.future.result(timeout=1), 'ok')
+        self.assertEqual([j.future.result(timeout=2) for j in submitted], [1, 2, 3])
+        self.assertEqual(peak[0], 1)
+        self.assertEqual({j.state for j in jobs.status()}, {'done'})
+        self.assertIn('half way', str(submitted[-1]))
+
+        failing = jobs.submit('fast', 'broken', lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            failing.future.result(timeout=1)
+        self.assertEqual(failing.state, 'failed')
+        self.assertEqual(jobs.status(active_only=True), [])
+
+    def test_queued_jobs_free_the_workers(self):
+        jobs = Jobs(workers=2, limits={'refresh': 1})
+        release = threading.Event()
+        self.addCleanup(jobs.shutdown)
+        self.addCleanup(release.set)
+        refreshes = [jobs.submit('refresh', f'chat {i}', release.wait, 2) for i in range(10)]
+        # Nine refreshes wait for their slot without holding a worker, the other worker stays free
+        fetch = jobs.submit('fetch', 'add a link', lambda: 'added')
+        self.assertEqual(fetch.future.result(timeout=1), 'added')
+        self.assertEqual([j.state for j in refreshes].count('queued'), 9)
+
+        refreshes[-1].future.cancel()
+        release.set()
+        self.assertEqual([j.future.result(timeout=2) for j in refreshes[:-1]], [True] * 9)
+        jobs.shutdown()
+        self.assertEqual(refreshes[-1].state, 'cancelled')
+
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        self.opened, self.closed = [], []
+
+        def opener(key):
+            time.sleep(0.02)
+            self.opened.append(key)
+            return {'key': key}
+
+        self.pool = HandlePool(opener, lambda h: self.closed.append(h['key']), max_open=2, idle_timeout=60)
+
+    def test_lru(self):
+        with self.pool.open(1) as h:
+            self.assertEqual(h, {'key': 1})
+            with self.pool.open(2):
+                pass
+            with self.pool.open(3):
+                self.assertEqual(len(self.pool), 3)  # Handles in use are never closed
+            self.assertEqual(self.closed, [2])  # 1 is in use, 2 is the least recently used
+        with self.pool.open(3):
+            pass
+        self.assertEqual(self.opened, [1, 2, 3])
+        self.assertEqual(sorted(h['key'] for h in self.pool.handles()), [1, 3])
+
+        with self.pool.open(2):
+            pass
+        self.assertEqual(self.closed, [2, 1])
+        self.pool.close_all()
+        self.assertEqual(sorted(self.closed), [1, 2, 2, 3])
+        self.assertEqual(len(self.pool), 0)
+
+    def test_idle(self):
+        self.pool.idle_timeout = 0.05
+        with self.pool.open(1):
+            time.sleep(0.1)
+            self.assertEqual(self.pool.sweep(), 0)
+        time.sleep(0.1)
+        self.assertEqual(self.pool.sweep(), 1)
+        self.assertNotIn(1, self.pool)
+
+    def test_open_once(self):
+        def use():
+            with self.pool.open('a'):
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=use) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.opened, ['a'])
+
+        failing = HandlePool(lambda key: 1 / 0, lambda h: None)
+        with self.assertRaises(ZeroDivisionError):
+            with failing.open('a'):
+                pass
+        self.assertEqual(len(failing), 0)
+
+    def test_isolation(self):
+        paths = [f'/tmp/bookmarket_pool_test_{i}.json' for i in range(2)]
+        for path in paths:
+            if os.path.isfile(path):
+                os.remove(path)
+        pool = HandlePool(lambda i: Bookmarket(paths[i]), Bookmarket.close)
+        self.addCleanup(pool.close_all)
+        with pool.open(0) as bm:
+            bm.write(Record(url='https://www.a.com', title='first chat'))
+        writing, done = threading.Event(), threading.Event()
+
+        def long_batch():  # A long write (like the commits of update_all) on the other chat
+            with pool.open(1) as bm, bm.batch():
+                bm.write(Record(url='https://www.b.com', title='second chat'))
+                writing.set()
+                done.wait(2)
+
+        t = threading.Thread(target=long_batch)
+        t.start()
+        writing.wait(1)
+        t0 = time.perf_counter()
+        with pool.open(0) as bm:
+            self.assertEqual([r.url for r in bm.search_text('chat')], ['https://www.a.com'])
+        self.assertLess(time.perf_counter() - t0, 0.5)
+        done.set()
+        t.join()
+
+        jobs = Jobs()
+        self.addCleanup(jobs.shutdown)
+        jobs.submit('fast', 'mine', lambda: None, owner=1).future.result(timeout=1)
+        jobs.submit('fast', 'theirs', lambda: None, owner=2).future.result(timeout=1)
+        self.assertEqual([j.desc for j in jobs.status(owner=1)], ['mine'])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_disabled(self):
+        metrics = Metrics()
+        bm = Bookmarket('/tmp/bookmarket_metrics_test.json')
+        self.addCleanup(bm.close)
+        get_url = bm.get_url
+        metrics.instrument(bm)
+        metrics.inc('calls')
+        with metrics.timer('op_seconds'):
+            pass
+        self.assertEqual(bm.get_url, get_url)
+        self.assertEqual(metrics.render(), '\n')
+
+    def test_instrument(self):
+        metrics = Metrics(enabled=True)
+        bm = Bookmarket('/tmp/bookmarket_metrics_test.json', cache=FetchCache())
+        bm.truncate()
+        self.addCleanup(bm.close)
+        metrics.instrument(bm)
+        bm.write([Record(url=f'www.site{i}.com', ts=i) for i in range(3)])
+        bm.get_url('www.site1.com')
+        with self.assertRaises(FileExistsError):
+            bm.write(Record(url='www.site1.com'))
+
+        text = metrics.render()
+        self.assertIn('# TYPE bookmarket_op_seconds histogram', text)
+        self.assertIn('bookmarket_op_seconds_count{op="write"} 2', text)
+        self.assertIn('bookmarket_op_seconds_bucket{op="get_url",le="+Inf"} 1', text)
+        self.assertIn('bookmarket_op_errors_total{error="FileExistsError",op="write"} 1', text)
+        self.assertIn('bookmarket_records 3', text)
+        self.assertIn('bookmarket_fetch_cache{outcome="hits"} 0', text)
+        self.assertIn('op="get_url"', metrics.summary())
+
+        server = metrics.serve(0)
+        self.addCleanup(metrics.shutdown)
+        with urlopen(f'http://127.0.0.1:{server.server_port}/metrics') as f:
+            self.assertIn(b'bookmarket_records 3', f.read())
+
+    def test_fetch(self):
+        server, base = serve(EtagSite)
+        self.addCleanup(server.shutdown)
+        METRICS.enable()
+        self.addCleanup(setattr, METRICS, 'enabled', False)
+        cache = FetchCache()
+        fetch(f'{base}/a', cache)
+        fetch(f'{base}/a', cache)
+        fetch('not a url')
+        text = METRICS.render()
+        self.assertIn('bookmarket_fetch_total{status="200"} 1', text)
+        self.assertIn('bookmarket_fetch_total{status="cached"} 1', text)
+        self.assertIn('bookmarket_fetch_total{status="error"} 1', text)
+        self.assertIn('bookmarket_fetch_errors_total{error=', text)
+
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        EtagSite.requests.clear()
+        RedirectSite.requests.clear()
+
+    def test_fetch_cache(self):
+        server, base = serve(EtagSite)
+        self.addCleanup(server.shutdown)
+        path = '/tmp/bookmarket_cache_test.json'
+        if os.path.isfile(path):
+            os.remove(path)
+        cache = FetchCache(path, max_entries=2)
+
+        self.assertEqual(find_infos(f'{base}/a', cache), ('page /a', None))
+        self.assertEqual(find_infos(f'{base}/a', cache), ('page /a', None))
+        self.assertEqual(EtagSite.requests, ['/a'])
+
+        # Stale entries are revalidated, the server answers 304
+        self.assertEqual(find_infos(f'{base}/a', cache, revalidate=True), ('page /a', None))
+        self.assertEqual(EtagSite.requests, ['/a', '/a'])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['revalidated'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        # Least recently used entries are evicted
+        find_infos(f'{base}/b', cache)
+        find_infos(f'{base}/a', cache)
+        find_infos(f'{base}/c', cache)
+        self.assertIsNone(cache.get(f'{base}/b'))
+        self.assertIsNotNone(cache.get(f'{base}/a'))
+
+        cache.save()
+        self.assertEqual(len(FetchCache(path)), 2)
+
+    def test_read_head(self):
+        head = [b'<html><head><ti', b'tle>Caf\xc3', b'\xa9 &amp; co</title>',
+                b'<meta property="og:description" content="a place">', b'</head>']
+        body = [b'<body>' + b'x' * 8192] * 100
+        req = FakeResponse(head + body)
+        self.assertEqual(read_head(req), ('Caf\u00e9 & co', 'a place'))
+        self.assertEqual(req.read, len(head))
+
+        # The byte cap stops pages without a </head>
+        req = FakeResponse([b'<html><title>t</title>'] + [b'<p>' + b'x' * 8192] * 100)
+        self.assertEqual(read_head(req, max_bytes=3 * 8192), ('t', None))
+        self.assertEqual(req.read, 4)
+
+        # Non html responses are never read
+        req = FakeResponse([b'%PDF-1.4'] * 10, content_type='application/pdf')
+        self.assertEqual(read_head(req), (None, None))
+        self.assertEqual(req.read, 0)
+
+    def test_fetch(self):
+        server, base = serve(RedirectSite)
+        self.addCleanup(server.shutdown)
+
+        res = fetch(f'{base}/old/page')
+        self.assertTrue(res.ok)
+        self.assertEqual(res.url, f'{base}/new/page')
+        self.assertEqual((res.title, res.info), ('page /new/page', 'about /new/page'))
+        self.assertEqual(RedirectSite.requests, ['/old/page', '/new/page'])
+
+        # The final url is remembered by the cache
+        cache = FetchCache()
+        fetch(f'{base}/old/x', cache)
+        self.assertEqual(fetch(f'{base}/old/x', cache).url, f'{base}/new/x')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        server.shutdown()
+        server.server_close()
+        self.assertFalse(fetch(f'{base}/old/page').ok)
+        self.assertFalse(fetch('not a url').ok)
+        self.assertEqual(find_infos(f'{base}/old/page'), (None, None))
+
+
+class TestSQLite(TestDB):
+    path = '/tmp/bookmarket_db_test.sqlite'
+
+    def test_migrate(self):
+        rs = [Record(url=f'https://www.site{i}.com', title=f'site {i}', info='info', ts=float(i)) for i in range(5)]
+        src = Bookmarket('/tmp/bookmarket_db_migrate.json')
+        src.truncate()
+        src.write(rs)
+        self.bm.write(rs[0])
+        self.assertEqual(migrate(src.storage, self.bm.storage), 4)
+        self.assertEqual(self.bm.all(), rs)
+        self.assertEqual(self.bm.search_text('site', '3'), [rs[3]])
+        src.truncate()
+        src.close()
+
+
+class TestLog(TestDB):
+    path = '/tmp/bookmarket_db_test.jsonl'
+
+    def test_replay(self):
+        rs = [Record(url=f'https://www.site{i}.com', title=f'site {i}', ts=float(i)) for i in range(6)]
+        self.bm.write(rs[:3])
+        self.bm.storage.compact()
+        self.assertTrue(os.path.isfile(self.path + '.snapshot'))
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+        self.bm.write(rs[3:])
+        self.bm.update(Record(url=rs[0].url, info='updated'))
+        self.bm.delete(rs[1])
+        expected = self.bm.all()
+
+        # A torn line left by a crash while appending is ignored
+        with open(self.path, 'a') as f:
+            f.write('[["i", 99, {"url": "https://www.torn')
+        self.bm.close()
+        self.bm = Bookmarket(self.path)
+        self.assertEqual(self.bm.all(), expected)
+        self.assertEqual(self.bm.search_text('updated'), [expected[0]])
+
+        # Commits after the restart are not glued to the torn line
+        b = Record(url='https://b.com', title='after the crash', ts=10.0)
+        self.bm.write(b)
+        self.bm.close()
+        self.bm = Bookmarket(self.path)
+        self.assertEqual(self.bm.all(), expected + [b])
+
+    def test_background_compaction(self):
+        self.bm.storage.compact_every = 5
+        for i in range(12):
+            self.bm.write(Record(url=f'https://www.site{i}.com', ts=float(i)))
+        self.bm.storage._compactor.join()
+        self.assertTrue(os.path.isfile(self.path + '.snapshot'))
+        self.assertLess(self.bm.storage._log_lines, 12)
+        self.bm.close()
+        self.bm = Bookmarket(self.path)
+        self.assertEqual(len(self.bm), 12)
+
+    def test_truncate_during_compaction(self):
+        self.bm.write([Record(url=f'https://www.site{i}.com', ts=float(i)) for i in range(3)])
+        dumping, resume = threading.Event(), threading.Event()
+        dump = json.dump
+
+        def slow_dump(*args, **kwargs):
+            dumping.set()
+            resume.wait(5)
+            dump(*args, **kwargs)
+
+        with mock.patch('bookmarket.storage.json.dump', slow_dump):
+            self.bm.storage.compact(background=True)
+            self.assertTrue(dumping.wait(5))
+            self.bm.truncate()
+            resume.set()
+            self.bm.storage._compactor.join()
+        self.assertEqual(len(self.bm), 0)
+        self.assertEqual(self.bm.storage._log_lines, 0)
+        self.assertFalse(os.path.isfile(self.path + '.snapshot.tmp'))
+
+        # The snapshot of the compaction does not bring the records back
+        self.bm.close()
+        self.bm = Bookmarket(self.path)
+        self.assertEqual(len(self.bm), 0)
+
 
 if __name__ == '__main__':
     unittest.main()